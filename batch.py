@@ -0,0 +1,275 @@
+import argparse
+import cache
+import lexer
+import os
+import sys
+
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from parser import Definition, Diagnostic, ParseError, parse_file, parse_toplevel, toplevel_spans
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+
+source_suffixes = (".c", ".h")
+
+
+class FileResult:
+    """
+    Outcome of parsing one file: its definitions (or whatever the caller
+    boiled them down to in the worker), or why it failed. A file with syntax
+    errors still has the definitions around them, plus the `diagnostics`.
+    """
+
+    __slots__ = ("path", "value", "error", "diagnostics")
+
+    def __init__(self, path: str, value: Any, error: Optional[str] = None, diagnostics: Optional[List[Diagnostic]] = None):
+        self.path = path
+        self.value = value
+        self.error = error
+        self.diagnostics = diagnostics or []
+
+
+def expand_paths(paths: Iterable[str]) -> Iterator[str]:
+    """Yields the given files, and every C source under the given directories."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(source_suffixes):
+                    yield os.path.join(root, name)
+
+
+class ParseFailure(Exception):
+    pass
+
+
+def guarded(fn: Callable, *args, **kwargs) -> Any:
+    """
+    Calls `fn`, turning any failure into a ParseFailure. Syntax errors are
+    only failures when `fn` wasn't given an `errors` list to recover with.
+    """
+    try:
+        return fn(*args, **kwargs)
+    except ParseError as e:
+        raise ParseFailure(str(e)) from None
+    except Exception as e:
+        raise ParseFailure(f"{type(e).__name__}: {e}") from None
+
+
+def parse_chunk(paths: List[str], process: Optional[Callable[[List[Definition]], Any]] = None) -> List[FileResult]:
+    results = []
+    for path in paths:
+        errors: List[Diagnostic] = []
+        try:
+            defns = guarded(parse_file, path, errors=errors)
+            results.append(FileResult(path, defns if process is None else guarded(process, defns), diagnostics=errors))
+        except ParseFailure as e:
+            results.append(FileResult(path, None, str(e), errors))
+    return results
+
+
+def encode_all(defns: List[Definition]) -> List[bytes]:
+    """
+    What a worker sends back when the caller wants whole ASTs: pickle
+    recurses as deep as the tree does, the cache's row tables don't.
+    """
+    return [cache.encode(defn) for defn in defns]
+
+
+def decode_all(blobs: List[bytes]) -> List[Definition]:
+    return [cache.decode(blob) for blob in blobs]
+
+
+def chunk_results(future, chunk: List[str], decode: bool) -> List[FileResult]:
+    """A chunk's results, or a failure for each of its files if the worker couldn't send them."""
+    try:
+        results = future.result()
+    except Exception as e:
+        return [FileResult(path, None, f"{type(e).__name__}: {e}") for path in chunk]
+    if decode:
+        for result in results:
+            if result.error is None:
+                result.value = decode_all(result.value)
+    return results
+
+
+def chunked(it: Iterable[str], size: int) -> Iterator[List[str]]:
+    it = iter(it)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+
+def parse_files(
+    paths: Iterable[str],
+    workers: Optional[int] = None,
+    chunksize: int = 8,
+    process: Optional[Callable[[List[Definition]], Any]] = None,
+) -> Iterator[FileResult]:
+    """
+    Parses files across a pool of `workers` processes, `chunksize` files per
+    task. Results come back in input order, and only a couple of chunks per
+    worker are in flight at any time, however many paths there are.
+
+    Sending whole ASTs back to this process costs about as much as parsing
+    them, so `process` (a picklable function) can reduce each file's
+    definitions to what the caller needs while still in the worker. Without
+    it, ASTs travel in the cache's flat encoding, so no depth of tree is too
+    deep to send. A chunk the worker can't send back fails its files only.
+    """
+    workers = workers or os.cpu_count() or 1
+    chunks = chunked(paths, chunksize)
+
+    if workers == 1:
+        for chunk in chunks:
+            yield from parse_chunk(chunk, process)
+        return
+
+    decode = process is None
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append((pool.submit(parse_chunk, chunk, encode_all if decode else process), chunk))
+            if len(pending) >= 2 * workers:
+                yield from chunk_results(*pending.popleft(), decode)
+        while pending:
+            yield from chunk_results(*pending.popleft(), decode)
+
+
+# The file a split-parsing worker is working on, set once per worker
+worker_file: Optional[lexer.TokenBuffer] = None
+
+
+def set_worker_file(file: str, source: str):
+    global worker_file
+    worker_file = lexer.TokenBuffer(file, source)
+
+
+def parse_tokens(kinds: array, starts: array, lengths: array, process: Optional[Callable[[List[Definition]], Any]]) -> Tuple[Any, List[Diagnostic]]:
+    toks = lexer.TokenBuffer(worker_file.file, worker_file.source)
+    toks.kinds, toks.starts, toks.lengths = kinds, starts, lengths
+    # Symbol IDs are per process, so they're worked out again here
+    toks.intern_symbols()
+    errors: List[Diagnostic] = []
+    defns = guarded(parse_toplevel, toks, errors=errors)
+    return (defns if process is None else process(defns)), errors
+
+
+def parse_file_split(
+    path: str,
+    workers: Optional[int] = None,
+    chunks_per_worker: int = 4,
+    process: Optional[Callable[[List[Definition]], Any]] = None,
+    errors: Optional[List[Diagnostic]] = None,
+) -> List[Any]:
+    """
+    Parses one file across a pool of `workers` processes. The file is lexed
+    here and cut into runs of whole top-level definitions by bracket depth;
+    each worker gets the whole source once and token columns per run, so
+    offsets in the source stay as they are.
+
+    Returns the definitions in file order. With `process`, each run's
+    definitions are reduced in the worker instead and the per-run results
+    are returned in file order. Syntax errors are added to `errors`, if
+    given, like `parse_toplevel` does.
+    """
+    with open(path) as input:
+        source = input.read()
+    toks = lexer.TokenBuffer.scan(path, source)
+    spans, rest = toplevel_spans(toks)
+    if rest < len(toks):
+        spans.append((rest, len(toks)))
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(spans) < 2:
+        defns = guarded(parse_toplevel, toks, errors=errors)
+        return defns if process is None else [process(defns)]
+
+    # Cut into runs of roughly equal token counts
+    target = len(toks) / (workers * chunks_per_worker)
+    runs = []
+    first = 0
+    for lo, hi in spans:
+        if hi - first >= target:
+            runs.append((first, hi))
+            first = hi
+    if first < len(toks):
+        runs.append((first, len(toks)))
+
+    with ProcessPoolExecutor(workers, initializer=set_worker_file, initargs=(path, source)) as pool:
+        futures = [
+            pool.submit(parse_tokens, toks.kinds[lo:hi], toks.starts[lo:hi], toks.lengths[lo:hi], process or encode_all)
+            for lo, hi in runs
+        ]
+        values = []
+        for future in futures:
+            value, run_errors = guarded(future.result)
+            values.append(value if process is not None else decode_all(value))
+            if errors is not None:
+                errors.extend(run_errors)
+            elif run_errors:
+                raise ParseFailure(str(run_errors[0]))
+    if process is not None:
+        return values
+    return [defn for defns in values for defn in defns]
+
+
+def split_results(paths: Iterable[str], workers: Optional[int], print: bool) -> Iterator[FileResult]:
+    for path in paths:
+        errors: List[Diagnostic] = []
+        try:
+            runs = parse_file_split(path, workers, process=render if print else len, errors=errors)
+        except ParseFailure as e:
+            yield FileResult(path, None, str(e), errors)
+            continue
+        if print:
+            yield FileResult(path, (sum(count for count, _ in runs), "\n".join(text for _, text in runs)), diagnostics=errors)
+        else:
+            yield FileResult(path, sum(runs), diagnostics=errors)
+
+
+def render(defns: List[Definition]) -> Tuple[int, str]:
+    return len(defns), "\n".join(map(str, defns))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argparser = argparse.ArgumentParser(description="Parse many C files in parallel.")
+    argparser.add_argument("paths", nargs="+", help="files, or directories to search for .c/.h files")
+    argparser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: one per core)")
+    argparser.add_argument("--chunksize", type=int, default=8, help="files handed to a worker at a time")
+    argparser.add_argument("--split", action="store_true", help="parse one file at a time, split across the workers")
+    argparser.add_argument("--print", action="store_true", help="print the parsed definitions")
+    args = argparser.parse_args(argv)
+
+    process = render if args.print else len
+    if args.split:
+        results = split_results(expand_paths(args.paths), args.workers, args.print)
+    else:
+        results = parse_files(expand_paths(args.paths), args.workers, args.chunksize, process)
+
+    files = failed = defns = 0
+    for result in results:
+        files += 1
+        for diagnostic in result.diagnostics:
+            print(diagnostic, file=sys.stderr)
+        if result.error is not None or result.diagnostics:
+            failed += 1
+        if result.error is not None:
+            print(f"{result.path}: {result.error}", file=sys.stderr)
+        elif args.print:
+            count, text = result.value
+            defns += count
+            print(text)
+        else:
+            defns += result.value
+
+    print(f"{files} files, {defns} definitions, {failed} failed", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
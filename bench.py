@@ -0,0 +1,315 @@
+import argparse
+import json
+import lexer
+import platform
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+from parser import parse_toplevel
+from typeck import LayoutEngine, data_models
+from typing import Callable, Dict, List, Optional, Tuple
+from visitor import Visitor
+
+
+class Corpus:
+    """
+    A seeded generator of C source that uses everything `parse_toplevel`
+    understands: structs and unions with attributes, declarations of every
+    type shape, long functions with nested control flow, deep and long
+    expressions, and large string literals. The same seed and scale always
+    give the same source.
+    """
+
+    infix_operators = ["*", "/", "%", "+", "-", "<<", ">>", "<", "<=", ">", ">=", "==", "!=", "&", "^", "|", "&&", "||"]
+    assign_operators = ["=", "+=", "-=", "*=", "/=", "%=", "<<=", ">>=", "&=", "^=", "|="]
+    scalar_types = ["int", "char", "short", "long", "unsigned", "unsigned long", "long long", "unsigned long long", "long int"]
+    names = ["a", "b", "c", "x", "y", "idx", "count", "ptr", "node", "value"]
+
+    def __init__(self, seed: int):
+        self.r = random.Random(seed)
+        self.records: List[str] = []
+
+    def ident(self) -> str:
+        return self.r.choice(self.names) + str(self.r.randrange(100))
+
+    def literal(self) -> str:
+        c = self.r.randrange(5)
+        if c == 0:
+            return str(self.r.randrange(100000))
+        elif c == 1:
+            return "0x%x" % self.r.randrange(1 << 16)
+        elif c == 2:
+            return "0b" + "".join(self.r.choice("01") for _ in range(8))
+        elif c == 3:
+            return self.r.choice(["'a'", "'\\n'", "'\\0'", "'\\x41'", "'z'"])
+        return '"' + self.text(self.r.randrange(1, 24)) + '"'
+
+    def text(self, length: int) -> str:
+        words = []
+        while sum(map(len, words)) < length:
+            words.append(self.r.choice(["lorem", "ipsum", "%d", "\\n", "\\t", "\\\"quoted\\\"", "dolor", "sit", "amet,"]))
+        return " ".join(words)
+
+    def atom(self, depth: int) -> str:
+        c = self.r.randrange(10)
+        if depth > 4 or c < 4:
+            return self.ident()
+        elif c < 6:
+            return self.literal()
+        elif c == 6:
+            return "(" + self.expression(depth + 1) + ")"
+        elif c == 7:
+            return self.r.choice(["-", "!", "~", "++", "--", "*", "&", "+"]) + " " + self.atom(depth + 1)
+        elif c == 8:
+            return self.atom(depth + 1) + self.r.choice(["++", "--", ".field", "->next", "[" + self.expression(depth + 1) + "]"])
+        return self.ident() + "[" + self.literal() + "]"
+
+    def expression(self, depth: int = 0, terms: Optional[int] = None) -> str:
+        terms = self.r.randrange(1, 7) if terms is None else terms
+        out = [self.atom(depth)]
+        for _ in range(terms - 1):
+            out += [self.r.choice(self.infix_operators), self.atom(depth)]
+        return " ".join(out)
+
+    def deep_expression(self, nesting: int) -> str:
+        """An expression nested `nesting` parentheses deep."""
+        return "(" * nesting + self.ident() + "".join(
+            " " + self.r.choice(self.infix_operators) + " " + self.atom(4) + ")" for _ in range(nesting)
+        )
+
+    def type_name(self) -> str:
+        if self.records and self.r.random() < 0.2:
+            return self.r.choice(self.records)
+        return self.r.choice(self.scalar_types)
+
+    def declarator(self) -> str:
+        c = self.r.randrange(5)
+        name = self.ident()
+        if c == 0:
+            return "*" * self.r.randrange(1, 4) + name
+        elif c == 1:
+            return f"{name}[{self.r.randrange(1, 64)}]"
+        elif c == 2:
+            return f"{name}[{self.r.randrange(1, 8)} * {self.r.randrange(1, 8)} + 1]"
+        return name
+
+    def record(self, i: int) -> str:
+        kind = "union" if self.r.random() < 0.25 else "struct"
+        name = f"{kind} rec{i}"
+        members = []
+        for j in range(self.r.randrange(1, 12)):
+            c = self.r.randrange(6)
+            if c == 0 and self.records:
+                # Held by value, so layouts depend on earlier records
+                members.append(f"{self.r.choice(self.records)} m{j};")
+            elif c == 1:
+                members.append(f"struct rec{self.r.randrange(i + 1)} *m{j};")
+            elif c == 2:
+                members.append(f"{self.r.choice(self.scalar_types)} m{j}[{self.r.randrange(1, 5)} * {self.r.randrange(1, 5)}];")
+            else:
+                members.append(f"{self.r.choice(self.scalar_types)} m{j};")
+        attrs = self.r.choice(["", "", "", " __attribute__((packed))", " __attribute__((aligned(16)))", " __attribute__((packed, aligned(4)))"])
+        self.records.append(name)
+        return f"{name} {{\n" + "".join(f"    {m}\n" for m in members) + f"}}{attrs};"
+
+    def declaration(self) -> str:
+        c = self.r.randrange(6)
+        mods = self.r.choice(["", "", "static ", "const ", "static const ", "volatile "])
+        if c == 0:
+            return f"{mods}{self.type_name()} {self.declarator()} = {self.expression()};"
+        elif c == 1:
+            return f"{mods}unsigned long int **(*{self.ident()}())[];"
+        elif c == 2:
+            return f"{self.type_name()} {self.ident()}({self.params()});"
+        return f"{mods}{self.type_name()} {self.declarator()};"
+
+    def params(self) -> str:
+        return ", ".join(f"{self.r.choice(self.scalar_types)} {self.declarator()}" for _ in range(self.r.randrange(4)))
+
+    def statement(self, depth: int = 0) -> str:
+        c = self.r.randrange(12)
+        if c == 0 and depth < 4:
+            body = " ".join(self.statement(depth + 1) for _ in range(self.r.randrange(1, 4)))
+            return f"if ({self.expression()}) {{ {body} }} else {self.statement(depth + 1)}"
+        elif c == 1 and depth < 4:
+            return f"if ({self.expression()}) {self.statement(depth + 1)}"
+        elif c == 2 and depth < 4:
+            body = " ".join(self.statement(depth + 1) for _ in range(self.r.randrange(1, 4)))
+            return f"while ({self.expression()}) {{ {body} }}"
+        elif c == 3:
+            return f"return {self.expression()};"
+        elif c == 4:
+            return self.r.choice(["break;", f"goto {self.ident()};"])
+        elif c == 5:
+            return f"{self.r.choice(self.records or self.scalar_types[:1])} {self.ident()};"
+        elif c == 6:
+            return f"{self.r.choice(['static ', 'const ', 'register '])}int {self.ident()} = {self.expression()};"
+        elif c == 7 and depth < 4:
+            return "{ " + " ".join(self.statement(depth + 1) for _ in range(self.r.randrange(3))) + " }"
+        elif c == 8:
+            return f"{self.ident()} {self.r.choice(self.assign_operators)} {self.expression()};"
+        return f"{self.expression()};"
+
+    def function(self, statements: int) -> str:
+        body = "".join(f"    {self.statement()}\n" for _ in range(statements))
+        return f"{self.type_name()} {self.ident()}_fn({self.params()}) {{\n{body}}}"
+
+    def generate(self, scale: int) -> str:
+        """About 70 KB of source per unit of `scale`."""
+        out = []
+        for i in range(scale):
+            for _ in range(40):
+                out.append(self.record(len(self.records)))
+            for _ in range(12):
+                out.append(self.declaration())
+            for _ in range(5):
+                out.append(self.function(self.r.randrange(5, 40)))
+            # One long function, one deep and one long expression, one big string
+            out.append(self.function(200))
+            out.append(f"int deep{i} = {self.deep_expression(self.r.randrange(50, 200))};")
+            out.append(f"int chain{i} = {self.expression(4, terms=self.r.randrange(500, 2000))};")
+            out.append(f"char *text{i} = \"{self.text(self.r.randrange(2000, 8000))}\";")
+        return "\n".join(out) + "\n"
+
+
+class NodeCounter(Visitor):
+    visit_types = False
+
+    def __init__(self):
+        super().__init__()
+        self.nodes = 0
+
+    def count(self, node):
+        self.nodes += 1
+
+    pre_param = pre_definition = pre_expression = pre_statement = count
+
+
+def best_time(fn: Callable, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(source: str, repeat: int = 3) -> Dict[str, float]:
+    """Times each stage on `source`, taking the best of `repeat` runs."""
+    results: Dict[str, float] = { "bytes": len(source) }
+
+    tokens = 0
+    def tokenize():
+        nonlocal tokens
+        tokens = sum(1 for _ in lexer.tokenize("bench.c", source))
+    elapsed = best_time(tokenize, repeat)
+    results["tokens"] = tokens
+    results["tokenize_tokens_per_sec"] = tokens / elapsed
+
+    toks = lexer.TokenBuffer.scan("bench.c", source)
+    elapsed = best_time(lambda: lexer.TokenBuffer.scan("bench.c", source), repeat)
+    results["scan_tokens_per_sec"] = len(toks) / elapsed
+
+    defns = parse_toplevel(toks)
+    counter = NodeCounter()
+    for defn in defns:
+        counter.walk(defn)
+    elapsed = best_time(lambda: parse_toplevel(toks), repeat)
+    results["nodes"] = counter.nodes
+    results["parse_nodes_per_sec"] = counter.nodes / elapsed
+
+    for name, model in sorted(data_models.items()):
+        engine = LayoutEngine(model)
+        def layout():
+            engine.__init__(model)
+            engine.update(defns)
+            engine.resolve()
+        elapsed = best_time(layout, repeat)
+        results["layouts"] = len(engine.records)
+        results[f"layouts_per_sec_{name}"] = len(engine.records) / elapsed
+    del defns
+
+    # Separately, since tracing slows everything down
+    tracemalloc.start()
+    parse_toplevel(lexer.TokenBuffer.scan("bench.c", source))
+    results["peak_parse_bytes"] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+# Metrics compared against a baseline, and whether bigger is better
+compared_metrics = {
+    "tokenize_tokens_per_sec": True,
+    "scan_tokens_per_sec": True,
+    "parse_nodes_per_sec": True,
+    "layouts_per_sec_ILP32": True,
+    "layouts_per_sec_LP64": True,
+    "peak_parse_bytes": False,
+}
+
+
+def regressions(results: Dict[str, float], baseline: Dict[str, float], threshold: float) -> List[Tuple[str, float, float]]:
+    """The metrics that got worse than `baseline` by more than `threshold` (a fraction)."""
+    worse = []
+    for metric, bigger_is_better in compared_metrics.items():
+        if metric not in results or not baseline.get(metric):
+            continue
+        change = results[metric] / baseline[metric] - 1
+        if (-change if bigger_is_better else change) > threshold:
+            worse.append((metric, baseline[metric], results[metric]))
+    return worse
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argparser = argparse.ArgumentParser(description="Benchmark the lexer, parser and layout engine.")
+    argparser.add_argument("files", nargs="*", help="benchmark these files instead of a generated corpus")
+    argparser.add_argument("--seed", type=int, default=0, help="seed of the generated corpus")
+    argparser.add_argument("--scale", type=int, default=20, help="size of the generated corpus, in units of about 70 KB")
+    argparser.add_argument("--repeat", type=int, default=3, help="runs per stage; the best one counts")
+    argparser.add_argument("--write-corpus", metavar="FILE", help="also save the generated corpus")
+    argparser.add_argument("-o", "--output", metavar="FILE", help="write the results here as JSON (default: stdout)")
+    argparser.add_argument("--baseline", metavar="FILE", help="results of an earlier run to compare against")
+    argparser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown against the baseline, as a fraction")
+    args = argparser.parse_args(argv)
+
+    if args.files:
+        sources = []
+        for file in args.files:
+            with open(file) as input:
+                sources.append(input.read())
+        source = "\n".join(sources)
+    else:
+        source = Corpus(args.seed).generate(args.scale)
+        if args.write_corpus:
+            with open(args.write_corpus, "w") as out:
+                out.write(source)
+
+    results = {
+        "python": platform.python_version(),
+        "corpus": args.files or { "seed": args.seed, "scale": args.scale },
+        "results": run(source, args.repeat),
+    }
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(report + "\n")
+    else:
+        print(report)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+        worse = regressions(results["results"], baseline, args.threshold)
+        for metric, before, after in worse:
+            print(f"regression: {metric} went from {before:.6g} to {after:.6g}", file=sys.stderr)
+        if worse:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
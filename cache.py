@@ -0,0 +1,288 @@
+import argparse
+import hashlib
+import json
+import lexer
+import marshal
+import mmap
+import os
+import sys
+import tempfile
+
+from array import array
+from collections.abc import Sequence
+from parser import Type, FunctionParam, Definition, Expression, Statement, VERSION, parse_toplevel
+from typing import Dict, List, Optional
+
+
+MAGIC = b"PJAST\0\0\1"
+
+# How every field of every AST class is serialized: VALUE fields as they are,
+# NODE fields as a reference to another row of the table (0 for None), NODES
+# fields as a list of references. UNSAVED fields are annotations that point
+# across definitions; they're saved as None and worked out again after loading.
+VALUE, NODE, NODES, UNSAVED = range(4)
+
+schema = {
+    Type: (VALUE, NODE, VALUE, NODE, NODES, NODE),
+    FunctionParam: (NODE, VALUE),
+    Definition: (VALUE, VALUE, NODE, NODES, NODES, NODE, NODE, NODES, VALUE, NODE),
+    Expression: (VALUE, NODE, VALUE, VALUE, VALUE, NODE, NODE, VALUE, VALUE, UNSAVED, VALUE),
+    Statement: (VALUE, NODE, NODE, VALUE, NODES, NODE, NODE),
+}
+node_classes = list(schema)
+class_codes = {cls: code for code, cls in enumerate(node_classes)}
+
+# The fields are the slots, except that a definition's body is saved parsed,
+# through its property, instead of as a lazy token span
+fields = {cls: cls.__slots__ for cls in node_classes}
+fields[Definition] = tuple("body" if name == "_body" else name for name in Definition.__slots__ if name != "lazy")
+
+for cls, kinds in schema.items():
+    assert len(kinds) == len(fields[cls]), f"cache schema out of date for {cls.__name__}"
+
+
+def encode(defn: Definition) -> bytes:
+    """
+    Serializes one definition as a flat table of rows, children before
+    parents, so neither writing nor reading it recurses. A node reachable
+    twice is written once.
+    """
+    table = []
+    rows: Dict[int, int] = {}
+    stack = [(defn, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if id(node) in rows:
+            continue
+        cls = type(node)
+        names = zip(fields[cls], schema[cls])
+        if not children_done:
+            stack.append((node, True))
+            for name, kind in names:
+                val = getattr(node, name)
+                if kind == NODE and val is not None:
+                    stack.append((val, False))
+                elif kind == NODES and val is not None:
+                    stack.extend((child, False) for child in reversed(val))
+            continue
+
+        row = [class_codes[cls]]
+        for name, kind in names:
+            val = getattr(node, name)
+            if kind == NODE:
+                val = 0 if val is None else rows[id(val)]
+            elif kind == NODES and val is not None:
+                val = [rows[id(child)] for child in val]
+            elif kind == UNSAVED:
+                val = None
+            row.append(val)
+        table.append(tuple(row))
+        rows[id(node)] = len(table)
+    return marshal.dumps(table)
+
+
+def make_builder(cls):
+    """Compiles a function that turns one table row back into a `cls` node."""
+    lines = ["def build(row, nodes):", "    node = new(cls)"]
+    for i, (name, kind) in enumerate(zip(fields[cls], schema[cls]), start=1):
+        if kind == VALUE or kind == UNSAVED:
+            lines.append(f"    node.{name} = row[{i}]")
+        elif kind == NODE:
+            lines.append(f"    node.{name} = nodes[row[{i}]]")
+        else:
+            lines.append(f"    node.{name} = None if row[{i}] is None else [nodes[i] for i in row[{i}]]")
+    lines.append("    return node")
+    namespace = {"new": object.__new__, "cls": cls}
+    exec("\n".join(lines), namespace)
+    return namespace["build"]
+
+def build_type(row, nodes) -> Type:
+    """Types go back through the factories, so they're shared with freshly parsed ones."""
+    _, storage, pointee, val, outty, paramtys, size = row
+    if paramtys is not None:
+        paramtys = [nodes[i] for i in paramtys]
+    return Type.make(storage, nodes[pointee], val, nodes[outty], paramtys, nodes[size])
+
+builders = [build_type if cls is Type else make_builder(cls) for cls in node_classes]
+
+
+def decode(blob) -> Definition:
+    nodes = [None]
+    add = nodes.append
+    for row in marshal.loads(blob):
+        add(builders[row[0]](row, nodes))
+    return nodes[-1]
+
+
+def write_entry(path: str, defns: List[Definition]):
+    blobs = [encode(defn) for defn in defns]
+    offsets = array("Q", [0])
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    header = len(MAGIC) + 8 + 8 * len(offsets)
+    offsets = array("Q", (header + offs for offs in offsets))
+
+    # Write next to the entry and rename, so readers never see half a file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as out:
+        out.write(MAGIC)
+        out.write(len(blobs).to_bytes(8, "little"))
+        out.write(offsets.tobytes())
+        for blob in blobs:
+            out.write(blob)
+    os.replace(tmp, path)
+
+
+class CachedDefinitions(Sequence):
+    """
+    The definitions of a cache entry, read from a memory-mapped file. Each
+    definition is decoded the first time it is accessed.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not an AST cache entry")
+        count = int.from_bytes(self.map[len(MAGIC):len(MAGIC) + 8], "little")
+        self.offsets = array("Q")
+        self.offsets.frombytes(self.map[len(MAGIC) + 8:len(MAGIC) + 8 + 8 * (count + 1)])
+        self.defns: List[Optional[Definition]] = [None] * count
+
+    def __len__(self) -> int:
+        return len(self.defns)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        defn = self.defns[i]
+        if defn is None:
+            i = range(len(self))[i]
+            defn = self.defns[i] = decode(self.map[self.offsets[i]:self.offsets[i + 1]])
+        return defn
+
+
+class ASTCache:
+    """
+    A directory of parsed files, keyed by a hash of the parser version and
+    the file contents. Entries are evicted least recently used first once
+    the directory grows past `max_bytes`.
+    """
+
+    STATS = "stats.json"
+
+    def __init__(self, directory: str, max_bytes: int = 1 << 30):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self) -> 'ASTCache':
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    @staticmethod
+    def key(source: str) -> str:
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f"{VERSION}:{marshal.version}:".encode())
+        digest.update(source.encode())
+        return digest.hexdigest()
+
+    def entry(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".ast")
+
+    def parse(self, file: str, source: str) -> Sequence:
+        path = self.entry(self.key(source))
+        try:
+            defns = CachedDefinitions(path)
+            os.utime(path)
+            self.hits += 1
+            return defns
+        except (OSError, ValueError):
+            pass
+
+        self.misses += 1
+        defns = parse_toplevel(lexer.TokenBuffer.scan(file, source))
+        write_entry(path, defns)
+        self.evict()
+        return defns
+
+    def parse_file(self, file: str) -> Sequence:
+        with open(file) as input:
+            return self.parse(file, input.read())
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(".ast"):
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, st.st_size, name))
+                total += st.st_size
+
+        entries.sort()
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    def stats(self) -> Dict[str, int]:
+        """Lifetime hit and miss counts, plus what the directory holds now."""
+        try:
+            with open(os.path.join(self.directory, self.STATS)) as file:
+                stats = json.load(file)
+        except (OSError, ValueError):
+            stats = { "hits": 0, "misses": 0 }
+        stats["hits"] += self.hits
+        stats["misses"] += self.misses
+
+        sizes = [
+            os.path.getsize(os.path.join(self.directory, name))
+            for name in os.listdir(self.directory) if name.endswith(".ast")
+        ]
+        stats["entries"] = len(sizes)
+        stats["bytes"] = sum(sizes)
+        return stats
+
+    def flush(self):
+        """Adds this session's hits and misses to the directory's totals."""
+        if not self.hits and not self.misses:
+            return
+        stats = self.stats()
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "w") as out:
+            json.dump({ "hits": stats["hits"], "misses": stats["misses"] }, out)
+        os.replace(tmp, os.path.join(self.directory, self.STATS))
+        self.hits = self.misses = 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argparser = argparse.ArgumentParser(description="Parse C files through an on-disk AST cache.")
+    argparser.add_argument("directory", help="cache directory")
+    commands = argparser.add_subparsers(dest="command", required=True)
+    parse_cmd = commands.add_parser("parse", help="parse files, using and filling the cache")
+    parse_cmd.add_argument("files", nargs="+")
+    parse_cmd.add_argument("--max-bytes", type=int, default=1 << 30, help="size bound of the cache directory")
+    parse_cmd.add_argument("--print", action="store_true", help="print the parsed definitions")
+    commands.add_parser("stats", help="show hit/miss counts and the cache size")
+    args = argparser.parse_args(argv)
+
+    if args.command == "stats":
+        for name, count in ASTCache(args.directory).stats().items():
+            print(f"{name}: {count}")
+        return 0
+
+    with ASTCache(args.directory, args.max_bytes) as cache:
+        for file in args.files:
+            defns = cache.parse_file(file)
+            if args.print:
+                print("\n".join(map(str, defns)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
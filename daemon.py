@@ -0,0 +1,209 @@
+import argparse
+import json
+import os
+import socketserver
+import stat
+import sys
+
+from incremental import IncrementalParser, content_hash
+from parser import Definition, ParseError
+from typeck import LP64, DataModel, LayoutEngine, LayoutError, data_models
+from typing import Callable, Dict, IO, List, Optional, Tuple
+
+
+class WatchedFile:
+    """
+    A file as the daemon last saw it: its definitions, kept up to date by an
+    `IncrementalParser`, and the layouts of its records. `stamp` is the
+    (mtime, size) the file had then, `digest` the hash of its contents, and
+    `reparsed` the number of definitions the last check had to parse.
+    """
+
+    __slots__ = ("path", "parser", "engine", "names", "stamp", "digest", "reparsed")
+
+    def __init__(self, path: str, model: DataModel):
+        self.path = path
+        self.parser = IncrementalParser(path)
+        self.engine = LayoutEngine(model)
+        self.names: Dict[str, List[Definition]] = {}
+        self.stamp: Optional[Tuple[int, int]] = None
+        self.digest: Optional[bytes] = None
+        self.reparsed = 0
+
+    def update(self, source: str):
+        defns = self.parser.update(source)
+        self.reparsed = self.parser.reparsed
+        self.engine.update(defns)
+        self.names = {}
+        for defn in defns:
+            if defn.name is not None:
+                self.names.setdefault(defn.name, []).append(defn)
+
+
+class Daemon:
+    """
+    Answers JSON requests about C files from ASTs and layouts kept in
+    memory. Before a request is answered its file is checked: if the mtime
+    or size changed the file is read again, and if its hash changed too,
+    only the definitions that changed are parsed and laid out again.
+
+    A request is an object with an `op` and the op's arguments, and an
+    optional `id` that is copied into the response:
+
+        {"op": "parse", "file": F}
+        {"op": "definition", "file": F, "name": N}
+        {"op": "layout", "file": F, "type": "struct foo"}
+        {"op": "invalidate", "file": F}     (every file without one)
+
+    Responses have `"ok": true` and the results, or `"ok": false` and an
+    `error` message.
+    """
+
+    def __init__(self, model: DataModel = LP64):
+        self.model = model
+        self.files: Dict[str, WatchedFile] = {}
+        # Every op, and the arguments it can't do without
+        self.ops: Dict[str, Tuple[Callable[[dict], dict], Tuple[str, ...]]] = {
+            "parse": (self.parse, ("file",)),
+            "definition": (self.definition, ("file", "name")),
+            "layout": (self.layout, ("file", "type")),
+            "invalidate": (self.invalidate, ()),
+        }
+
+    def refresh(self, file: str) -> WatchedFile:
+        path = os.path.abspath(file)
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        watched = self.files.get(path)
+        if watched is not None:
+            watched.reparsed = 0
+            if watched.stamp == stamp:
+                return watched
+
+        with open(path) as input:
+            source = input.read()
+        digest = content_hash(source)
+        if watched is None:
+            watched = WatchedFile(path, self.model)
+        if watched.digest != digest:
+            # A syntax error leaves the file as it was last parsed
+            watched.update(source)
+            watched.digest = digest
+        watched.stamp = stamp
+        self.files[path] = watched
+        return watched
+
+    def parse(self, request: dict) -> dict:
+        watched = self.refresh(request["file"])
+        return {
+            "definitions": [{"storage": d.storage, "name": d.name} for d in watched.parser.definitions],
+            "reparsed": watched.reparsed,
+        }
+
+    def definition(self, request: dict) -> dict:
+        watched = self.refresh(request["file"])
+        defns = watched.names.get(request["name"])
+        if not defns:
+            raise LookupError(f"no definition of `{request['name']}` in {request['file']}")
+        return {"definitions": [str(d) for d in defns]}
+
+    def layout(self, request: dict) -> dict:
+        watched = self.refresh(request["file"])
+        tl = watched.engine.named(request["type"])
+        paths, offsets, sizes = tl.member_table().export()
+        return {
+            "name": tl.name,
+            "size": tl.size,
+            "align": tl.align,
+            "members": [{"path": p, "offset": o, "size": s} for p, o, s in zip(paths, offsets, sizes)],
+        }
+
+    def invalidate(self, request: dict) -> dict:
+        file = request.get("file")
+        if file is None:
+            count = len(self.files)
+            self.files.clear()
+        else:
+            count = int(self.files.pop(os.path.abspath(file), None) is not None)
+        return {"invalidated": count}
+
+    def handle(self, line: str) -> dict:
+        """The response to one request line."""
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return {"ok": False, "error": f"invalid JSON: {e}"}
+        if not isinstance(request, dict):
+            return {"ok": False, "error": "a request has to be an object"}
+
+        response = {"id": request["id"]} if "id" in request else {}
+        if request.get("op") not in self.ops:
+            return dict(response, ok=False, error=f"unknown op `{request.get('op')}`")
+        op, arguments = self.ops[request["op"]]
+        missing = [name for name in arguments if name not in request]
+        if missing:
+            return dict(response, ok=False, error=f"missing argument '{missing[0]}'")
+
+        try:
+            response.update(op(request))
+            response["ok"] = True
+        except KeyError as e:
+            # The arguments are all there, so this is a lookup gone wrong inside the op
+            response.update(ok=False, error=f"{type(e).__name__}: {e}")
+        except (OSError, ParseError, LayoutError, LookupError) as e:
+            response.update(ok=False, error=str(e))
+        except Exception as e:
+            # Whatever else goes wrong only fails this request
+            response.update(ok=False, error=f"{type(e).__name__}: {e}")
+        return response
+
+    def serve(self, input: IO[str], output: IO[str]):
+        """Answers requests, one JSON object per line, until `input` ends."""
+        for line in input:
+            if line.strip():
+                output.write(json.dumps(self.handle(line)) + "\n")
+                output.flush()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if line.strip():
+                self.wfile.write(json.dumps(self.server.daemon.handle(line.decode())).encode() + b"\n")
+
+
+def serve_socket(daemon: Daemon, path: str):
+    """Answers requests on a Unix socket at `path`, one connection at a time."""
+    # Only a stale socket is cleared away, never some other file
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.unlink(path)
+    with socketserver.UnixStreamServer(path, RequestHandler) as server:
+        server.daemon = daemon
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(path)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argparser = argparse.ArgumentParser(description="Serve parsed C files and their layouts from memory.")
+    argparser.add_argument("--socket", metavar="PATH", help="listen on a Unix socket instead of stdin/stdout")
+    argparser.add_argument("--model", choices=sorted(data_models), default=LP64.name, help="data model for layouts")
+    args = argparser.parse_args(argv)
+
+    daemon = Daemon(data_models[args.model])
+    if args.socket is None:
+        daemon.serve(sys.stdin, sys.stdout)
+    else:
+        try:
+            serve_socket(daemon, args.socket)
+        except KeyboardInterrupt:
+            pass
+        except OSError as e:
+            print(f"cannot listen on {args.socket}: {e}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+import argparse
+import printer
+import sys
+
+from parser import Diagnostic, Expression, Type, parse_iter, scan_file
+from typeck import Arithmetic, Constant, DataModel, LP64, data_models
+from typing import List, Optional
+from visitor import SKIP, Visitor
+
+
+# Operators that give back their left operand when the right one is this
+right_identities = {
+    "+": 0, "-": 0, "|": 0, "^": 0, "<<": 0, ">>": 0,
+    "*": 1, "/": 1,
+}
+# ...and their right operand when the left one is this
+left_identities = { "+": 0, "|": 0, "^": 0, "*": 1 }
+
+
+def integer(value: int, name: str) -> Expression:
+    e = Expression()
+    e.storage = Expression.INTEGER
+    e.ty = Type.value(name.split())
+    e.intval = value
+    return e
+
+
+def computed_size(ty: Type) -> bool:
+    """Whether `ty` is, or is built on, an array whose size is an expression."""
+    while ty is not None:
+        if ty.storage == Type.ARRAY and ty.size is not None and ty.size.storage != Expression.INTEGER:
+            return True
+        ty = ty.outty if ty.storage == Type.FUNCPTR else ty.pointee
+    return False
+
+
+class Folder(Visitor):
+    """
+    Replaces constant prefix and infix expressions by INTEGER literals, with
+    C's integer semantics under `model`, and drops operations that can't
+    change their other operand (`x * 1`, `x + 0`, ...). Expressions whose
+    result C leaves undefined are kept as they are. Array sizes are folded
+    too, so their types become the interned types of literal-sized arrays.
+
+    Dropping an identity also drops the integer promotion it implied, so
+    `c + 0` for a char `c` becomes a plain char.
+    """
+
+    def __init__(self, model: DataModel = LP64):
+        super().__init__()
+        self.arith = Arithmetic(model)
+        # Nodes removed from the tree
+        self.folded = 0
+
+    def pre_type(self, t: Type):
+        if not computed_size(t):
+            return SKIP
+
+    def constant(self, e: Expression) -> Optional[Constant]:
+        return self.arith.literal(e) if e.storage == Expression.INTEGER else None
+
+    def post_expression(self, e: Expression) -> Optional[Expression]:
+        if e.storage == Expression.PREFIX:
+            a = self.constant(e.exp1)
+            if a is not None and (value := self.arith.prefix(e.op, a)) is not None:
+                self.folded += 1
+                return integer(*value)
+
+        elif e.storage == Expression.INFIX:
+            a = self.constant(e.exp1)
+            b = self.constant(e.exp2)
+            if a is not None and b is not None:
+                value = self.arith.infix(e.op, a, b)
+            elif a is not None:
+                # The right operand isn't evaluated if the left one decides
+                if (e.op == "&&" and a[0] == 0) or (e.op == "||" and a[0] != 0):
+                    self.folded += count(e.exp2) + 1
+                    return integer(int(e.op == "||"), "int")
+                if left_identities.get(e.op) == a[0]:
+                    self.folded += 2
+                    return e.exp2
+                return None
+            elif b is not None:
+                if right_identities.get(e.op) == b[0]:
+                    self.folded += 2
+                    return e.exp1
+                return None
+            else:
+                return None
+
+            if value is not None:
+                self.folded += 2
+                return integer(*value)
+        return None
+
+
+class Counter(Visitor):
+    visit_types = False
+
+    def __init__(self):
+        super().__init__()
+        self.nodes = 0
+
+    def pre_expression(self, e: Expression):
+        self.nodes += 1
+
+
+def count(e: Expression) -> int:
+    counter = Counter()
+    counter.walk(e)
+    return counter.nodes
+
+
+def fold(node, model: DataModel = LP64):
+    """Folds the constants in `node` in place. Returns `node`, or what replaced it."""
+    return Folder(model).walk(node)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argparser = argparse.ArgumentParser(description="Print C files with their constant expressions folded.")
+    argparser.add_argument("files", nargs="+")
+    argparser.add_argument("--model", choices=sorted(data_models), default=LP64.name, help="data model for integer widths")
+    args = argparser.parse_args(argv)
+
+    folder = Folder(data_models[args.model])
+    errors: List[Diagnostic] = []
+    for file in args.files:
+        printer.write(map(folder.walk, parse_iter(scan_file(file), errors=errors)), sys.stdout)
+    for diagnostic in errors:
+        print(diagnostic, file=sys.stderr)
+    print(f"{folder.folded} nodes folded away", file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+import hashlib
+import lexer
+
+from bisect import bisect_left, bisect_right
+from parser import Definition, parse_toplevel, toplevel_spans
+from typing import Dict, List, Optional
+
+
+def content_hash(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+def common_prefix(a: str, b: str) -> int:
+    n = min(len(a), len(b))
+    lo, step = 0, 4096
+    # Skip over equal blocks with C-level compares, then narrow down
+    while lo < n:
+        hi = min(lo + step, n)
+        if a[lo:hi] == b[lo:hi]:
+            lo = hi
+            step *= 2
+        elif step > 64:
+            step //= 8
+        else:
+            break
+    while lo < n and a[lo] == b[lo]:
+        lo += 1
+    return lo
+
+
+def common_suffix(a: str, b: str, limit: int) -> int:
+    n = min(len(a), len(b), limit)
+    lo, step = 0, 4096
+    while lo < n:
+        hi = min(lo + step, n)
+        if a[len(a) - hi:len(a) - lo] == b[len(b) - hi:len(b) - lo]:
+            lo = hi
+            step *= 2
+        elif step > 64:
+            step //= 8
+        else:
+            break
+    while lo < n and a[len(a) - lo - 1] == b[len(b) - lo - 1]:
+        lo += 1
+    return lo
+
+
+class Record:
+    """
+    The source span (first to last token) of one top-level definition and
+    what it parsed to. That is a single `Definition` unless the input is
+    malformed enough for the parser and the bracket scan to disagree.
+    """
+
+    __slots__ = ("start", "end", "digest", "defns")
+
+    def __init__(self, start: int, end: int, digest: bytes, defns: List[Definition]):
+        self.start = start
+        self.end = end
+        self.digest = digest
+        self.defns = defns
+
+
+class IncrementalParser:
+    """
+    Keeps the top-level definitions of one file across edits. After an edit
+    only the definitions whose source changed are lexed and parsed again;
+    the rest keep their `Definition` objects.
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        self.source: Optional[str] = None
+        self.records: List[Record] = []
+        # Number of definitions the last update had to parse
+        self.reparsed = 0
+
+    @property
+    def definitions(self) -> List[Definition]:
+        return [defn for rec in self.records for defn in rec.defns]
+
+    def update(self, source: str) -> List[Definition]:
+        """Moves to a new version of the whole file."""
+        self.reparsed = 0
+        if self.source is None:
+            self.records = self._parse_region(source, 0, len(source), {})
+            self.source = source
+            return self.definitions
+
+        old = self.source
+        prefix = common_prefix(old, source)
+        suffix = common_suffix(old, source, min(len(old), len(source)) - prefix)
+        return self._apply(source, prefix, len(old) - suffix)
+
+    def edit(self, start: int, end: int, text: str) -> List[Definition]:
+        """Replaces `source[start:end]` with `text`, like an editor would."""
+        if self.source is None:
+            # Nothing parsed yet: the edit gives the whole file
+            return self.update(text)
+        self.reparsed = 0
+        old = self.source
+        return self._apply(old[:start] + text + old[end:], start, end)
+
+    def _apply(self, source: str, changed_start: int, changed_end: int) -> List[Definition]:
+        # `changed_start:changed_end` is the damaged range in old coordinates
+        records = self.records
+        delta = len(source) - len(self.source)
+
+        # Definitions that end before the change are untouched, as are those
+        # that start after it, unless the relexed region spills into them.
+        first = bisect_right([rec.end for rec in records], changed_start)
+        last = max(first, bisect_left([rec.start for rec in records], changed_end))
+
+        region_start = records[first - 1].end if first else 0
+        while True:
+            region_stop = records[last].start + delta if last < len(records) else len(source)
+            new_records = self._parse_region(
+                source, region_start, region_stop,
+                { rec.digest: rec for rec in records[first:last] },
+            )
+            if new_records is not None:
+                break
+            last += 1
+
+        for rec in records[last:]:
+            rec.start += delta
+            rec.end += delta
+
+        self.records = records[:first] + new_records + records[last:]
+        self.source = source
+        return self.definitions
+
+    def _parse_region(self, source: str, start: int, stop: int, reusable: Dict[bytes, Record]) -> Optional[List[Record]]:
+        """
+        Parses the definitions in `source[start:stop]`. Returns None if the
+        region doesn't end on a definition boundary, e.g. because the edit
+        opened a bracket or a comment that carries on past `stop`.
+        """
+        toks = lexer.TokenBuffer.scan(self.file, source, start, stop)
+        spans, rest = toplevel_spans(toks)
+
+        if stop < len(source):
+            if rest != len(toks) or (len(toks) and toks.end(len(toks) - 1) > stop):
+                return None
+            if lexer.next_token(source, toks.end(len(toks) - 1) if len(toks) else start) != stop:
+                return None
+        elif rest != len(toks):
+            spans.append((rest, len(toks)))
+
+        out = []
+        for lo, hi in spans:
+            span = toks.starts[lo], toks.end(hi - 1)
+            digest = content_hash(source[span[0]:span[1]])
+            if (rec := reusable.pop(digest, None)) is not None:
+                defns = rec.defns
+            else:
+                defns = parse_toplevel(toks, lo, hi)
+                self.reparsed += 1
+            out.append(Record(*span, digest, defns))
+        return out
@@ -0,0 +1,195 @@
+import lexer
+import time
+
+from collections import Counter
+from typing import Callable, Dict, Iterator, List, Optional, TextIO, Union
+
+
+class Production:
+    """
+    Counters for one of the parser's productions. Time and tokens only count
+    the outermost call when a production nests inside itself, so they are
+    never counted twice; expects and peeks are charged to the innermost
+    production running.
+    """
+
+    __slots__ = ("name", "calls", "seconds", "tokens", "expects", "failures", "peeks", "active")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.tokens = 0
+        self.expects = 0
+        self.failures = 0
+        self.peeks = 0
+        self.active = 0
+
+
+class DefinitionTiming:
+    """How long one top-level definition took to parse, and its token range."""
+
+    __slots__ = ("name", "first", "last", "seconds")
+
+    def __init__(self, name: Optional[str], first: int, last: int, seconds: float):
+        self.name = name
+        self.first = first
+        self.last = last
+        self.seconds = seconds
+
+
+class Stats:
+    """
+    Collects timings and hot-path counters from the lexer and parser. Pass one
+    as `stats` to `parse_iter` or `parse_toplevel` and the parser swaps its
+    closures for counting wrappers; without one nothing is wrapped, so
+    parsing costs what it always did. Lex through `scan` or `tokenize` to
+    time the lexer too.
+
+    Callables appended to `on_phase` are called with a phase name and its
+    seconds whenever a phase ends, and ones appended to `on_definition` with
+    the DefinitionTiming of each top-level definition as it is parsed.
+    """
+
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self.tokens = 0
+        self.expects = 0
+        self.failures = 0
+        # peek(n) calls by n
+        self.peek_depths: Counter = Counter()
+        self.productions: Dict[str, Production] = {}
+        self.definitions: List[DefinitionTiming] = []
+        self.on_phase: List[Callable[[str, float], None]] = []
+        self.on_definition: List[Callable[[DefinitionTiming], None]] = []
+        self.running: List[Production] = []
+
+    def phase(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+        for hook in self.on_phase:
+            hook(name, seconds)
+
+    def scan(self, file: str, source: Union[str, bytes], start: int = 0, stop: Optional[int] = None) -> lexer.TokenBuffer:
+        """`lexer.TokenBuffer.scan`, timed as the "lex" phase."""
+        begin = time.perf_counter()
+        toks = lexer.TokenBuffer.scan(file, source, start, stop)
+        self.phase("lex", time.perf_counter() - begin)
+        self.tokens += len(toks)
+        return toks
+
+    def tokenize(self, file: str, input: str) -> Iterator[lexer.Token]:
+        """`lexer.tokenize`, timed as the "lex" phase, leaving out the time spent by the consumer."""
+        clock = time.perf_counter
+        it = lexer.tokenize(file, input)
+        elapsed = 0.0
+        count = 0
+        while True:
+            begin = clock()
+            tok = next(it, None)
+            elapsed += clock() - begin
+            if tok is None:
+                break
+            count += 1
+            yield tok
+        self.phase("lex", elapsed)
+        self.tokens += count
+
+    def production(self, name: str) -> Production:
+        prod = self.productions.get(name)
+        if prod is None:
+            prod = self.productions[name] = Production(name)
+        return prod
+
+    # The wrappers below are installed by `parse_iter`. `position` gives the
+    # parser's current token index.
+
+    def wrap_expect(self, expect: Callable) -> Callable:
+        running = self.running
+
+        def counted_expect(*args, **kwargs):
+            tok = expect(*args, **kwargs)
+            self.expects += 1
+            if running:
+                running[-1].expects += 1
+            if tok is None:
+                self.failures += 1
+                if running:
+                    running[-1].failures += 1
+            return tok
+        return counted_expect
+
+    def wrap_peek(self, peek: Callable) -> Callable:
+        running = self.running
+        depths = self.peek_depths
+
+        def counted_peek(n: int = 0) -> int:
+            depths[n] += 1
+            if running:
+                running[-1].peeks += 1
+            return peek(n)
+        return counted_peek
+
+    def wrap_production(self, fn: Callable, position: Callable[[], int]) -> Callable:
+        prod = self.production(fn.__name__)
+        running = self.running
+        clock = time.perf_counter
+
+        def timed(*args):
+            prod.calls += 1
+            prod.active += 1
+            running.append(prod)
+            first = position()
+            begin = clock()
+            try:
+                return fn(*args)
+            finally:
+                running.pop()
+                prod.active -= 1
+                if not prod.active:
+                    prod.seconds += clock() - begin
+                    prod.tokens += position() - first
+        timed.__name__ = fn.__name__
+        return timed
+
+    def toplevel(self, take_definition: Callable, done: Callable[[], bool], position: Callable[[], int]) -> Iterator:
+        """
+        Parses definitions until `done`, timing each one and the whole as the
+        "parse" phase. `take_definition` gives None for a definition it had
+        to skip over because of errors.
+        """
+        clock = time.perf_counter
+        elapsed = 0.0
+        try:
+            while not done():
+                first = position()
+                begin = clock()
+                defn = take_definition()
+                seconds = clock() - begin
+                elapsed += seconds
+                if defn is None:
+                    continue
+                timing = DefinitionTiming(defn.name, first, position(), seconds)
+                self.definitions.append(timing)
+                for hook in self.on_definition:
+                    hook(timing)
+                yield defn
+        finally:
+            self.phase("parse", elapsed)
+
+    def report(self, out: TextIO, slowest: int = 10):
+        """Writes a human-readable summary of everything counted."""
+        for name, seconds in self.phases.items():
+            print(f"{name:>8}: {seconds * 1000:10.2f} ms", file=out)
+        print(f"tokens lexed: {self.tokens}", file=out)
+        print(f"expect calls: {self.expects}, failed: {self.failures}", file=out)
+        depths = ", ".join(f"{n}: {count}" for n, count in sorted(self.peek_depths.items()))
+        print(f"peek calls by depth: {depths or 'none'}", file=out)
+
+        print(f"\n{'production':<24}{'calls':>9}{'ms':>11}{'tokens':>9}{'expects':>9}{'failed':>9}{'peeks':>8}", file=out)
+        for p in sorted(self.productions.values(), key=lambda p: p.seconds, reverse=True):
+            print(f"{p.name:<24}{p.calls:>9}{p.seconds * 1000:>11.2f}{p.tokens:>9}{p.expects:>9}{p.failures:>9}{p.peeks:>8}", file=out)
+
+        if self.definitions:
+            print("\nslowest definitions:", file=out)
+            for d in sorted(self.definitions, key=lambda d: d.seconds, reverse=True)[:slowest]:
+                print(f"{d.seconds * 1000:10.2f} ms  {d.name}  (tokens {d.first}-{d.last})", file=out)
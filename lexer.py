@@ -1,35 +1,305 @@
+import mmap
+import os
 import re
 
-from typing import Iterator, Tuple
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 tokens = [
-    r"[ \n\t]+" # whitespace
-    r"\/\/[^\n]*", # comment
     r"(?P<integer>(?:0x[a-fA-F0-9]+|0b[01]+|[0-9]+)[luLU]*)",
     r"(?P<word>[_a-zA-Z0-9]+)",
     r"(?P<delimiter>[,?:;])",
     r"(?P<bracket>[\(\){}\[\]])",
     r"(?P<string>\"(?:[^\\]|\\.)*?\")",
-    r"(?P<char>'(?:[^\\]|\\.)')",
-    r"(?P<operator>->|<<|>>|&&|\|\||\+\+|--|[.~!=+\-*\/%&^|]=?)",
+    r"(?P<char>'(?:[^'\\\n]|\\.)+')",
+    r"(?P<operator>->|<<=?|>>=?|&&|\|\||\+\+|--|[.~!=<>+\-*\/%&^|]=?)",
+]
+
+skipped = [
+    r"[ \n\t]+", # whitespace
+    r"\/\/[^\n]*", # comment
 ]
 
-tokenizer = re.compile("|".join(tokens))
+# Whitespace and comments are folded into the front of the following match, so
+# they never produce a match of their own. Unknown characters and the end of
+# input fall through to the unnamed alternatives and come out with no kind.
+tokenizer = re.compile(
+    f"(?:{'|'.join(skipped)})*(?:{'|'.join(tokens)}|.|\\Z)",
+    re.DOTALL,
+)
+
+# The same tokenizer for bytes-like input, e.g. a memory-mapped file
+byte_tokenizer = re.compile(tokenizer.pattern.encode(), re.DOTALL)
+
+# Token kinds are the tokenizer's group numbers, so `match.lastindex` is the
+# kind of a match without looking at any of the other groups.
+INTEGER, WORD, DELIMITER, BRACKET, STRING, CHAR, OPERATOR = range(1, len(tokens) + 1)
+
+kind_names = [None] + sorted(tokenizer.groupindex, key=tokenizer.groupindex.get)
+assert kind_names[WORD] == "word" and kind_names[OPERATOR] == "operator"
 
 Token = Tuple[str, str]
 TokenStream = Iterator[Token]
 
-def first_item(d):
-    for it in d.items():
-        return it
-    return None
+
+class SymbolTable:
+    """
+    Gives every distinct word and punctuator a dense integer ID, and keeps a
+    single copy of its text, so a name that appears a thousand times is
+    stored once. IDs are handed out in the order symbols are first seen, so
+    they only mean something within one process; ASTs hold the shared
+    names instead, which survive pickling and the on-disk cache.
+    """
+
+    def __init__(self, seed: Iterable[str] = ()):
+        self.names: List[str] = []
+        # Keyed by both str and (for mapped sources) bytes spellings
+        self.ids: Dict[Union[str, bytes], int] = {}
+        for name in seed:
+            self.intern(name)
+
+    def intern(self, text: Union[str, bytes]) -> int:
+        sym = self.ids.get(text)
+        if sym is None:
+            name = text if isinstance(text, str) else str(text, "utf-8")
+            sym = self.ids.get(name)
+            if sym is None:
+                sym = len(self.names)
+                self.names.append(name)
+                self.ids[name] = sym
+            self.ids[text] = sym
+        return sym
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+# Keyword classes, a bit each
+MODIFIER, INTEGRAL, TYPE_NAME, RECORD, CONTROL, ATTRIBUTE = (1 << i for i in range(6))
+
+keyword_classes = {
+    "static": MODIFIER, "const": MODIFIER, "inline": MODIFIER, "register": MODIFIER, "volatile": MODIFIER,
+    "char": INTEGRAL | TYPE_NAME, "byte": INTEGRAL | TYPE_NAME, "short": INTEGRAL | TYPE_NAME,
+    "int": INTEGRAL | TYPE_NAME, "long": INTEGRAL | TYPE_NAME,
+    "struct": RECORD | TYPE_NAME, "union": RECORD | TYPE_NAME, "enum": TYPE_NAME,
+    "void": TYPE_NAME, "signed": TYPE_NAME, "unsigned": TYPE_NAME, "float": TYPE_NAME, "double": TYPE_NAME,
+    "switch": CONTROL, "case": CONTROL, "return": CONTROL, "break": CONTROL, "for": CONTROL,
+    "while": CONTROL, "if": CONTROL, "else": CONTROL, "do": CONTROL, "goto": CONTROL,
+    # Only keywords inside `__attribute__((...))`
+    "packed": ATTRIBUTE, "__packed__": ATTRIBUTE, "aligned": ATTRIBUTE, "__aligned__": ATTRIBUTE,
+}
+
+# Symbol 0 stands for no symbol: literals aren't interned. Keywords come
+# next, so a symbol is a keyword exactly when its ID is below
+# `keyword_count`, and its classes are one index away.
+symbols = SymbolTable([""] + list(keyword_classes))
+keyword_count = len(symbols)
+symbol_classes = bytes([0] + list(keyword_classes.values()))
+
+# Tokens of these kinds are interned as they are lexed
+interned_kinds = bytes(kind in (WORD, DELIMITER, BRACKET, OPERATOR) for kind in range(len(tokens) + 1))
+
+
+def keywords(cls: int) -> Set[str]:
+    """The keywords in any of the classes `cls`."""
+    return {word for word, word_cls in keyword_classes.items() if word_cls & cls}
+
+
+# C's escape sequences. Numeric escapes give the value of a (byte-sized) char.
+simple_escapes = {
+    "n": "\n", "t": "\t", "r": "\r", "a": "\a", "b": "\b", "f": "\f", "v": "\v",
+    "\\": "\\", "'": "'", "\"": "\"", "?": "?",
+    # A backslash at the end of a line joins the next one on
+    "\n": "",
+}
+escape = re.compile(r"\\(?:([0-7]{1,3})|x([0-9a-fA-F]+)|u([0-9a-fA-F]{4})|U([0-9a-fA-F]{8})|(.))", re.DOTALL)
+
+
+def unescape(match: re.Match) -> str:
+    octal, hex, short, long, other = match.groups()
+    if other is not None:
+        # Unknown escapes stand for the character itself, as most compilers have it
+        return simple_escapes.get(other, other)
+    if octal is not None:
+        return chr(int(octal, 8) & 0xFF)
+    if hex is not None:
+        return chr(int(hex, 16) & 0xFF)
+    return chr(min(int(short or long, 16), 0x10FFFF))
+
+def decode_escapes(text: str) -> str:
+    """The characters of a literal's contents, with C's escape sequences replaced."""
+    return escape.sub(unescape, text) if "\\" in text else text
+
+
+class StringPool:
+    """
+    Decodes each distinct string or char literal once, and keeps a single
+    copy of every distinct value, so a literal repeated all over a file is
+    decoded and stored once. Nodes share the pooled str itself rather than
+    an ID, so ASTs still pickle and cache as they are.
+    """
+
+    def __init__(self):
+        # Literal spellings, quotes included, to their values
+        self.literals: Dict[str, str] = {}
+        self.values: Dict[str, str] = {}
+
+    def decode(self, literal: str) -> str:
+        value = self.literals.get(literal)
+        if value is None:
+            value = decode_escapes(literal[1:-1])
+            value = self.literals[literal] = self.values.setdefault(value, value)
+        return value
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+strings = StringPool()
+
+def scan(input: str) -> Iterator[Tuple[int, int, int]]:
+    for match in tokenizer.finditer(input):
+        kind = match.lastindex
+        if kind:
+            yield kind, match.start(kind), match.end(kind)
+
+def next_token(input: str, offset: int) -> int:
+    """Start offset of the first token at or after `offset`, or the input length."""
+    for match in tokenizer.finditer(input, offset):
+        kind = match.lastindex
+        if kind:
+            return match.start(kind)
+    return len(input)
 
 def tokenize(file: str, input: str) -> Iterator[Tuple[str, str]]:
+    names = kind_names
     for match in tokenizer.finditer(input):
-        token_set = { k: v for k, v in match.groupdict().items() if v is not None }
-        if len(token_set) > 1:
-            print(f"[{file}:{match.pos}] Found ambiguous input token `{match.string}`!")
-            exit(-1)
-        
-        if pair := first_item(token_set):
-            yield pair
+        kind = match.lastindex
+        if kind:
+            yield names[kind], match[kind]
+
+
+class TokenBuffer:
+    """
+    All tokens of one source, stored column-wise: kind, start offset, length
+    and symbol each live in their own `array`. Words and punctuators are
+    interned into `symbols` as they are lexed; other token text is only
+    sliced out of `source` when somebody asks for it.
+
+    Lengths and symbols are 16-bit until a token longer than 64K or a
+    symbol past the 64Kth comes along, so most sources take 9 bytes per
+    token.
+
+    `source` is normally a str, but can be any bytes-like object (such as an
+    mmap) holding UTF-8, in which case offsets are byte offsets and text is
+    decoded as it is sliced.
+    """
+
+    def __init__(self, file: str, source: Union[str, bytes, mmap.mmap]):
+        offset_code = "I" if len(source) <= 0xFFFFFFFF else "Q"
+        self.file = file
+        self.source = source
+        self.kinds = array("B")
+        self.starts = array(offset_code)
+        self.lengths = array("H")
+        self.syms = array("H" if len(symbols) <= 0xFFFF else "I")
+
+    @staticmethod
+    def scan(file: str, source: Union[str, bytes, mmap.mmap], start: int = 0, stop: Optional[int] = None) -> 'TokenBuffer':
+        """
+        Lexes `source` from offset `start`. With a `stop` offset, lexing ends
+        before the first token that begins at or after it; the last token
+        kept may still run past `stop`.
+        """
+        toks = TokenBuffer(file, source)
+        while True:
+            try:
+                toks.lex(start, stop)
+                return toks
+            except OverflowError:
+                start = toks.widen(start)
+
+    def lex(self, start: int, stop: Optional[int]):
+        source = self.source
+        matcher = tokenizer if isinstance(source, str) else byte_tokenizer
+        add_kind = self.kinds.append
+        add_start = self.starts.append
+        add_length = self.lengths.append
+        add_sym = self.syms.append
+        symbol = symbols.ids.get
+        intern = symbols.intern
+        interned = interned_kinds
+        if stop is None:
+            for match in matcher.finditer(source, start):
+                kind = match.lastindex
+                if kind:
+                    begin = match.start(kind)
+                    add_kind(kind)
+                    add_start(begin)
+                    add_length(match.end(kind) - begin)
+                    if interned[kind]:
+                        text = match[kind]
+                        add_sym(symbol(text) or intern(text))
+                    else:
+                        add_sym(0)
+        else:
+            for match in matcher.finditer(source, start):
+                kind = match.lastindex
+                if kind:
+                    begin = match.start(kind)
+                    if begin >= stop:
+                        break
+                    add_kind(kind)
+                    add_start(begin)
+                    add_length(match.end(kind) - begin)
+                    if interned[kind]:
+                        text = match[kind]
+                        add_sym(symbol(text) or intern(text))
+                    else:
+                        add_sym(0)
+
+    def widen(self, start: int) -> int:
+        """
+        Makes lengths and symbols 32-bit after one of them overflowed, and
+        drops the token that was half added. Returns where to lex on from.
+        """
+        n = min(len(self.kinds), len(self.starts), len(self.lengths), len(self.syms))
+        del self.kinds[n:], self.starts[n:], self.lengths[n:], self.syms[n:]
+        self.lengths = array("I", self.lengths)
+        self.syms = array("I", self.syms)
+        return self.end(n - 1) if n else start
+
+    def intern_symbols(self):
+        """Fills in `syms` from the other columns, e.g. ones sent over from another process."""
+        source = self.source
+        intern = symbols.intern
+        interned = interned_kinds
+        self.syms = array("I", (
+            intern(source[start:start + length]) if interned[kind] else 0
+            for kind, start, length in zip(self.kinds, self.starts, self.lengths)
+        ))
+
+    @staticmethod
+    def map_file(file: str) -> 'TokenBuffer':
+        """
+        Lexes a file through a read-only memory map, so the file's contents
+        are never copied into a str.
+        """
+        with open(file, "rb") as input:
+            source = mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(input.fileno()).st_size else b""
+        return TokenBuffer.scan(file, source)
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def __getitem__(self, i: int) -> Token:
+        return kind_names[self.kinds[i]], self.text(i)
+
+    def end(self, i: int) -> int:
+        """Offset just past token `i`."""
+        return self.starts[i] + self.lengths[i]
+
+    def text(self, i: int) -> str:
+        start = self.starts[i]
+        text = self.source[start:start + self.lengths[i]]
+        return text if isinstance(text, str) else str(text, "utf-8")
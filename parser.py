@@ -1,7 +1,13 @@
 import lexer
 
-from typing import List, Tuple, Optional, Set, Deque
-from collections import deque
+from lexer import INTEGER, WORD, DELIMITER, BRACKET, STRING, CHAR, OPERATOR
+from lexer import MODIFIER, INTEGRAL, TYPE_NAME, RECORD, CONTROL, ATTRIBUTE
+from typing import Callable, Dict, Iterator, List, Tuple, Optional, Sequence, Set
+
+
+# Bump whenever the AST built for some input changes shape; anything that
+# persists ASTs keys on it.
+VERSION = 5
 
 
 def dbg(what):
@@ -12,20 +18,58 @@ def dbg(what):
     return printed
 
 
-modifier_keywords = {
-    "static", "const", "inline", "register", "volatile"
-}
-int_keywords = {
-    "char", "byte", "short", "int", "long"
-}
-type_keywords = int_keywords | {
-    "struct", "union", "enum",
-    "void", "signed", "unsigned", "float", "double"
-}
-control_keywords = {
-    "switch", "case", "return", "break", "for", "while", "if", "else", "do", "goto"
+# The lexer classifies keywords; these are the words of each class
+modifier_keywords = lexer.keywords(MODIFIER)
+int_keywords = lexer.keywords(INTEGRAL)
+type_keywords = lexer.keywords(TYPE_NAME)
+record_keywords = lexer.keywords(RECORD)
+# `__attribute__`s understood on struct and union definitions
+record_attributes = lexer.keywords(ATTRIBUTE)
+control_keywords = lexer.keywords(CONTROL)
+
+prefix_operators = {"++", "--", "~", "!", "*", "-", "+", "&"}
+postfix_operators = {"++", "--", ".", "->"}
+postfix_brackets = {"[", "("}
+
+# Infix operators, loosest first.
+# TODO: ternary, comma
+binary_operators = [
+    {"=", "+=", "-=", "*=", "/=", "%=", "<<=", ">>=", "&=", "^=", "|="},
+    {"||"},
+    {"&&"},
+    {"|"},
+    {"^"},
+    {"&"},
+    {"==", "!="},
+    {"<", "<=", ">=", ">"},
+    {"<<", ">>"},
+    {"+", "-"},
+    {"*", "/", "%"},
+]
+
+# (left, right) binding power of every infix operator. An operator only takes
+# the expression to its left if its left power is at least the current minimum,
+# and parses its right operand with its right power as the new minimum.
+# Everything is left-associative, assignment included, as the parser has
+# always grouped it; a right-associative row would be (bp, bp).
+binding_powers = {
+    op: (bp, bp + 1)
+    for bp, ops in enumerate(binary_operators, start=1)
+    for op in ops
 }
 
+# The parser compares symbol IDs rather than text
+symbol = lexer.symbols.intern
+LPAREN, RPAREN, LBRACE, RBRACE, LSQUARE, RSQUARE = map(symbol, "(){}[]")
+SEMICOLON, COMMA, STAR, ASSIGN = map(symbol, ";,*=")
+SIGNED, UNSIGNED, LONG, INT, DOUBLE, ELSE, ATTRIBUTE_KEYWORD = map(
+    symbol, ["signed", "unsigned", "long", "int", "double", "else", "__attribute__"]
+)
+prefix_symbols = set(map(symbol, prefix_operators))
+postfix_symbols = set(map(symbol, postfix_operators))
+postfix_bracket_symbols = set(map(symbol, postfix_brackets))
+symbol_powers = {symbol(op): bp for op, bp in binding_powers.items()}
+
 
 class Type:
     POINTER = "pointer"
@@ -33,77 +77,147 @@ class Type:
     FUNCPTR = "funcptr"
     ARRAY = "array"
 
-    storage = None
-    pointee = None
-    val = None
-    outty = None
-    paramtys = None
-    size = None
+    __slots__ = ("storage", "pointee", "val", "outty", "paramtys", "size")
+
+    # Types are hash-consed: the factories hand out one shared, never mutated
+    # object per distinct type, so types compare (and hash) by identity.
+    # Arrays are only shared when their size is absent or a literal.
+    interned: Dict[tuple, 'Type'] = {}
+
+    def __init__(self):
+        self.storage = None
+        self.pointee = None
+        self.val = None
+        self.outty = None
+        self.paramtys = None
+        self.size = None
 
     @staticmethod
     def pointer(pointee):
-        t = Type()
-        t.storage = Type.POINTER
-        t.pointee = pointee
+        key = (Type.POINTER, pointee)
+        t = Type.interned.get(key)
+        if t is None:
+            t = Type.interned[key] = Type()
+            t.storage = Type.POINTER
+            t.pointee = pointee
         return t
 
     @staticmethod
-    def value(what: List[str]):
-        t = Type()
-        t.storage = Type.VALUE
-        t.val = what
+    def value(what: Sequence[str]):
+        what = tuple(what)
+        key = (Type.VALUE, what)
+        t = Type.interned.get(key)
+        if t is None:
+            t = Type.interned[key] = Type()
+            t.storage = Type.VALUE
+            t.val = what
         return t
 
     @staticmethod
     def funcptr(outty, paramtys: List):
-        t = Type()
-        t.storage = Type.FUNCPTR
-        t.outty = outty
-        t.paramtys = paramtys
+        key = (Type.FUNCPTR, outty, tuple(paramtys))
+        t = Type.interned.get(key)
+        if t is None:
+            t = Type.interned[key] = Type()
+            t.storage = Type.FUNCPTR
+            t.outty = outty
+            t.paramtys = paramtys
         return t
     
     @staticmethod
     def array(pointee, size):
-        t = Type()
-        t.storage = Type.ARRAY
-        t.pointee = pointee
-        t.size = size
+        if size is None:
+            key = (Type.ARRAY, pointee, None)
+        elif size.storage == Expression.INTEGER:
+            key = (Type.ARRAY, pointee, size.ty, size.intval)
+        else:
+            key = None
+
+        t = Type.interned.get(key) if key else None
+        if t is None:
+            t = Type()
+            t.storage = Type.ARRAY
+            t.pointee = pointee
+            t.size = size
+            if key:
+                Type.interned[key] = t
         return t
+
+    @staticmethod
+    def make(storage: str, pointee, val, outty, paramtys, size):
+        """Builds a type from its fields through the interning factories."""
+        if storage == Type.POINTER:
+            return Type.pointer(pointee)
+        elif storage == Type.VALUE:
+            return Type.value(val)
+        elif storage == Type.FUNCPTR:
+            return Type.funcptr(outty, paramtys)
+        elif storage == Type.ARRAY:
+            return Type.array(pointee, size)
+
+    def __reduce__(self):
+        # Unpickled types are interned in the receiving process too
+        return Type.make, (self.storage, self.pointee, self.val, self.outty, self.paramtys, self.size)
     
     def __str__(self):
-        if self.storage == self.POINTER:
-            return f"Type *{{{self.pointee}}}"
-        elif self.storage == self.VALUE:
-            val = " ".join(map(str, self.val))
-            return f"Type {{{val}}}"
-        elif self.storage == self.FUNCPTR:
-            return f"Type fn({self.paramtys}) -> {{{self.outty}}})"
-        elif self.storage == self.ARRAY:
-            return f"Type {{{self.pointee}}}[{self.size}]"
+        # Printed without recursion, so any depth of tree is fine
+        from printer import to_string
+        return to_string(self)
+
+
+# The types of integer and character literals, shared by every literal
+int_type = Type.value(["int"])
+char_type = Type.value(["char"])
 
 
 
 class FunctionParam:
+    __slots__ = ("ty", "name")
+
     def __init__(self, ty: Type, name: Optional[str] = None):
         self.ty = ty
         self.name = name
     
     def __str__(self):
-        return f"Param {self.name}: {self.ty}"
+        from printer import to_string
+        return to_string(self)
 
 
 
 class Definition:
     FUNCTION = "function"
     VALUE = "value"
-
-    storage = None
-    name = None
-    outty = None
-    paramtys = None
-    body = None
-    ty = None
-    val = None
+    STRUCT = "struct"
+    UNION = "union"
+
+    # A function body skipped by a lazy parse is kept as `lazy`, the
+    # `(toks, start, stop)` of its tokens, until `body` is first read
+    __slots__ = ("storage", "name", "outty", "paramtys", "_body", "ty", "val", "members", "packed", "align", "lazy")
+
+    def __init__(self):
+        self.storage = None
+        self.name = None
+        self.outty = None
+        self.paramtys = None
+        self._body = None
+        self.ty = None
+        self.val = None
+        self.members = None
+        self.packed = None
+        self.align = None
+        self.lazy = None
+
+    @property
+    def body(self) -> Optional[List['Statement']]:
+        if self.lazy is not None:
+            self._body = parse_body(*self.lazy)
+            self.lazy = None
+        return self._body
+
+    @body.setter
+    def body(self, body: Optional[List['Statement']]):
+        self._body = body
+        self.lazy = None
 
     @staticmethod
     def function(name: Optional[str], outty: Type, paramtys: List[FunctionParam], body: List['Statement']):
@@ -115,6 +229,13 @@ class Definition:
         d.body = body
         return d
 
+    @staticmethod
+    def lazy_function(name: Optional[str], outty: Type, paramtys: List[FunctionParam], toks: lexer.TokenBuffer, start: int, stop: int):
+        """A function whose body, tokens `start` to `stop` of `toks`, is parsed when first needed."""
+        d = Definition.function(name, outty, paramtys, None)
+        d.lazy = (toks, start, stop)
+        return d
+
     @staticmethod
     def value(name: Optional[str], ty: Type, value: 'Expression'):
         d = Definition()
@@ -124,19 +245,20 @@ class Definition:
         d.val = value
         return d
 
-    def __str__(self):
-        if self.storage == self.VALUE:
-            if self.val is not None:
-                return f"Define {self.name}: {{{self.ty}}} = {self.val}"
-            return f"Declare {self.name}: {{{self.ty}}}"
-
-        elif self.storage == self.FUNCTION:
-            params = ", ".join( map(str, self.paramtys) )
-            if self.body is not None:
-                body = "\n".join(map("    {}".format, self.body))
-                return f"Define fn {self.name}({params}) -> {{{self.outty}}}\n{{\n{body}\n}}"
-            return f"Declare fn {self.name}({params}) -> {{{self.outty}}}"
+    @staticmethod
+    def record(kind: str, name: Optional[str], members: List[FunctionParam], packed: bool, align: Optional['Expression']):
+        """A struct or union definition. `align` is the argument of `aligned`, if given."""
+        d = Definition()
+        d.storage = kind
+        d.name = name
+        d.members = members
+        d.packed = packed
+        d.align = align
+        return d
 
+    def __str__(self):
+        from printer import to_string
+        return to_string(self)
 
 
 
@@ -150,15 +272,23 @@ class Expression:
     VARIABLE = "variable"
     INFIX = "infix"
 
-    storage = None
-    ty = None
-    strval = None
-    intval = None
-    op = None
-    exp1 = None
-    exp2 = None
-    varname = None
-    ident = None
+    # `decl` is the Definition or FunctionParam a VARIABLE refers to, once
+    # typeck has resolved names. `decimal` tells decimal INTEGER literals from
+    # hex, octal and binary ones, which C gives unsigned types more readily
+    __slots__ = ("storage", "ty", "strval", "intval", "op", "exp1", "exp2", "varname", "ident", "decl", "decimal")
+
+    def __init__(self):
+        self.storage = None
+        self.ty = None
+        self.strval = None
+        self.intval = None
+        self.op = None
+        self.exp1 = None
+        self.exp2 = None
+        self.varname = None
+        self.ident = None
+        self.decl = None
+        self.decimal = None
 
     @staticmethod
     def variable(name: str):
@@ -171,30 +301,44 @@ class Expression:
     def char(literal: str):
         e = Expression()
         e.storage = Expression.INTEGER
-        e.ty = Type.value(["char"])
-        e.intval = ord(eval(literal))
+        e.ty = char_type
+        value = lexer.strings.decode(literal)
+        if len(value) == 1:
+            e.intval = ord(value)
+        else:
+            # A multi-character constant is an int, its chars packed as bytes like GCC does
+            e.ty = int_type
+            e.intval = 0
+            for c in value:
+                e.intval = (e.intval << 8) | (ord(c) & 0xFF)
         return e
 
     @staticmethod
     def string(literal: str):
         e = Expression()
         e.storage = Expression.STRING
-        e.strval = eval(literal)
+        e.strval = lexer.strings.decode(literal)
         return e
 
     @staticmethod
     def integer(literal: str):
         e = Expression()
         e.storage = Expression.INTEGER
-        e.ty = Type.value(["int"])
-        if literal.startswith("0x"):
-            e.intval = int(literal[2:], base=16)
-        elif literal.startswith("0b"):
-            e.intval = int(literal[2:], base=2)
-        elif literal.startswith("0") and literal != "0":
-            e.intval = int(literal[1:], base=8)
+        e.ty = int_type
+        digits = literal.rstrip("luLU")
+        # `u` makes it unsigned, `l` long and `ll` long long
+        suffix = literal[len(digits):].lower()
+        if suffix:
+            e.ty = Type.value((["unsigned"] if "u" in suffix else []) + (["long"] * suffix.count("l") or ["int"]))
+        if digits.startswith("0x"):
+            e.intval = int(digits[2:], base=16)
+        elif digits.startswith("0b"):
+            e.intval = int(digits[2:], base=2)
+        elif digits.startswith("0") and digits != "0":
+            e.intval = int(digits[1:], base=8)
         else:
-            e.intval = int(literal)
+            e.intval = int(digits)
+        e.decimal = digits[0] != "0" or digits == "0"
         return e
     
     @staticmethod
@@ -240,23 +384,8 @@ class Expression:
         return e
     
     def __str__(self):
-        if self.storage == self.VARIABLE:
-            return f"(Var {self.varname})"
-        elif self.storage == self.INTEGER:
-            return f"({self.ty} {self.intval})"
-        elif self.storage == self.STRING:
-            return f"\"{self.strval}\""
-        elif self.storage == self.PREFIX:
-            return f"({self.op} {self.exp1})"
-        elif self.storage == self.POSTFIX:
-            return f"({self.exp1} {self.op})"
-        elif self.storage == self.INFIX:
-            return f"({self.exp1} {self.op} {self.exp2})"
-        elif self.storage == self.DECONSTRUCT:
-            return f"({self.exp1} {self.op} {self.ident})"
-        elif self.storage == self.INDEX:
-            return f"({self.exp1} [ {self.exp2} ])"
-
+        from printer import to_string
+        return to_string(self)
 
 
 
@@ -270,13 +399,16 @@ class Statement:
     IF = "if"
     WHILE = "while"
 
-    storage = None
-    val = None
-    defn = None
-    ident = None
-    blk = None
-    body = None
-    body_else = None
+    __slots__ = ("storage", "val", "defn", "ident", "blk", "body", "body_else")
+
+    def __init__(self):
+        self.storage = None
+        self.val = None
+        self.defn = None
+        self.ident = None
+        self.blk = None
+        self.body = None
+        self.body_else = None
 
     @staticmethod
     def expression(expr: Expression):
@@ -337,201 +469,355 @@ class Statement:
         return s
     
     def __str__(self):
-        if self.storage == self.DEFINITION:
-            return str(self.defn)
-        if self.storage == self.BLOCK:
-            return "{ " + "\n".join(map(str, self.blk)) + " }"
-        elif self.storage == self.EXPRESSION:
-            return f"Apply {self.val}"
-        elif self.storage == self.RETURN:
-            return f"Return {self.val}"
-        elif self.storage == self.GOTO:
-            return f"Goto {self.ident}"
-        elif self.storage == self.BREAK:
-            return f"Break"
-        elif self.storage == self.IF:
-            elsestr = ""
-            if self.body_else is not None:
-                elsestr = f" Else {self.body_else}"
-            return f"If {self.val} {self.body}" + elsestr
-        elif self.storage == self.WHILE:
-            return f"While {self.val} {self.body}"
-
-
-
-
-def parse_toplevel(tokstr: lexer.TokenStream) -> List[Definition]:
-    taken: Deque[lexer.Token] = deque()
-
-    def take() -> lexer.Token:
-        nonlocal taken
-        if not len(taken):
-            out = next(tokstr)
-        else:
-            out = taken.popleft()
-        return out
+        from printer import to_string
+        return to_string(self)
 
-    def peek(n = None) -> lexer.Token:
-        nonlocal taken
 
-        deref = n is None
-        n = n or 1
-        
-        while len(taken) < n:
-            taken.append(next(tokstr))
-        
-        if deref:
-            return taken[0]
-        else:
-            return list(taken)[:n]
-    
+
+
+class Diagnostic:
+    """A syntax error, at `offset` in the source of `file`."""
+
+    __slots__ = ("file", "offset", "line", "column", "message")
+
+    def __init__(self, file: str, offset: int, line: int, column: int, message: str):
+        self.file = file
+        self.offset = offset
+        self.line = line
+        self.column = column
+        self.message = message
+
+    @staticmethod
+    def at(toks: lexer.TokenBuffer, offset: int, message: str) -> 'Diagnostic':
+        """Works out the (1-based) line and column of `offset` in `toks.source`."""
+        source = toks.source
+        newline = "\n" if isinstance(source, str) else b"\n"
+        line_start = source.rfind(newline, 0, offset) + 1
+        # An mmap has no `count`, but its slices are bytes
+        line = (source.count(newline, 0, line_start) if isinstance(source, (str, bytes)) else source[:line_start].count(newline)) + 1
+        return Diagnostic(toks.file, offset, line, offset - line_start + 1, message)
+
+    def __str__(self):
+        return f"{self.file}:{self.line}:{self.column}: {self.message}"
+
+
+class ParseError(Exception):
+    def __init__(self, diagnostic: Diagnostic):
+        super().__init__(str(diagnostic))
+        self.diagnostic = diagnostic
+
+
+def parse_toplevel(
+    toks: lexer.TokenBuffer, start: int = 0, stop: Optional[int] = None, stats = None, lazy: bool = False,
+    errors: Optional[List[Diagnostic]] = None,
+) -> List[Definition]:
+    return list(parse_iter(toks, start, stop, stats, lazy, errors))
+
+
+def parse_iter(
+    toks: lexer.TokenBuffer, start: int = 0, stop: Optional[int] = None, stats = None, lazy: bool = False,
+    errors: Optional[List[Diagnostic]] = None,
+) -> Iterator[Definition]:
+    """
+    Yields each top-level definition as soon as it has been parsed. Given an
+    `instrument.Stats`, the parse is timed and counted into it. With `lazy`,
+    function bodies are only brace-matched, and parsed when first accessed.
+
+    A syntax error raises ParseError, unless an `errors` list is given: then
+    every error is added to it, and parsing carries on after the `;` or `}`
+    that ends the broken statement or definition. What could be parsed is
+    still produced, so the result is a partial AST.
+    """
+    return grammar(toks, start, stop, stats, lazy, errors)[0]()
+
+
+def parse_body(toks: lexer.TokenBuffer, start: int, stop: int) -> List['Statement']:
+    """Parses a function body from the token after its `{` through its `}`."""
+    return grammar(toks, start, stop)[1]()
+
+
+def parse_expression(toks: lexer.TokenBuffer, start: int = 0, stop: Optional[int] = None) -> Expression:
+    """Parses tokens `start` to `stop` as one expression, which has to use up all of them."""
+    return grammar(toks, start, stop)[2]()
+
+
+def grammar(
+    toks: lexer.TokenBuffer, start: int, stop: Optional[int], stats = None, lazy: bool = False,
+    errors: Optional[List[Diagnostic]] = None,
+) -> Tuple[Callable[[], Iterator[Definition]], Callable[[], List['Statement']], Callable[[], Expression]]:
+    """
+    The parser's productions over tokens `start` to `stop`: returns a generator
+    function over the top-level definitions, the production of the rest of a
+    function body after its `{`, and that of an expression filling the range.
+    """
+    kinds = toks.kinds
+    starts = toks.starts
+    lengths = toks.lengths
+    syms = toks.syms
+    source = toks.source
+    names = lexer.symbols.names
+    classes = lexer.symbol_classes
+    keyword_count = lexer.keyword_count
+    end = len(kinds) if stop is None else stop
+    pos = start
+
+    if isinstance(source, str):
+        def text(i: int) -> str:
+            begin = starts[i]
+            return source[begin:begin + lengths[i]]
+    else:
+        # Mapped bytes: only the tokens the parser looks at get decoded
+        def text(i: int) -> str:
+            begin = starts[i]
+            return str(source[begin:begin + lengths[i]], "utf-8")
+
+    def peek(n: int = 0) -> int:
+        """Kind of the token `n` places past the cursor, or 0 past the end."""
+        i = pos + n
+        return kinds[i] if i < end else 0
+
     def done():
-        try:
-            peek(1)
-            return False
-        except StopIteration:
-            return True
-
-    def expect(ty: str, val: str = None, vset = None, check: bool = False) -> Optional[str]:
-        tok = peek()
-        if val is not None and tok[1] != val:
+        return pos >= end
+
+    def describe(i: int) -> str:
+        return f"{lexer.kind_names[kinds[i]]} `{text(i)}`" if i < end else "end of input"
+
+    def error(message: str) -> ParseError:
+        """An error at the cursor, to be raised."""
+        if pos < end:
+            offset = starts[pos]
+        else:
+            offset = toks.end(end - 1) if end > start else 0
+        return ParseError(Diagnostic.at(toks, offset, message))
+
+    def recover(in_body: bool):
+        """
+        Panic mode: skips past the `;` or `}` that ends whatever was being
+        parsed, keeping count of brackets on the way. In a body, a `}` that
+        closes the body itself is left for it to take. Braces never appear
+        inside parentheses, so they forget about any unclosed `(` or `[`.
+        """
+        nonlocal pos
+        braces = parens = 0
+        while pos < end:
+            kind = kinds[pos]
+            if kind == DELIMITER and braces == 0 and parens == 0 and syms[pos] == SEMICOLON:
+                pos += 1
+                return
+            elif kind == BRACKET:
+                c = syms[pos]
+                if c == LBRACE:
+                    braces += 1
+                    parens = 0
+                elif c == RBRACE:
+                    parens = 0
+                    if braces == 0:
+                        if in_body:
+                            return
+                    else:
+                        braces -= 1
+                        if braces == 0:
+                            pos += 1
+                            return
+                elif c == LPAREN or c == LSQUARE:
+                    parens += 1
+                elif parens > 0:
+                    parens -= 1
+            pos += 1
+
+    if lazy:
+        # Brackets are found with bytes.find rather than token by token
+        kind_bytes = kinds.tobytes()
+        bracket = bytes([BRACKET])
+        opener, closer = ("{", "}") if isinstance(source, str) else (ord("{"), ord("}"))
+
+    def skip_body() -> Optional[int]:
+        """
+        After a `{`, moves past its matching `}` without parsing anything in
+        between, and returns where the body began. Returns None, having moved
+        nowhere, if the `}` never comes.
+        """
+        nonlocal pos
+        depth = 1
+        i = kind_bytes.find(bracket, pos, end)
+        while i >= 0:
+            c = source[starts[i]]
+            if c == opener:
+                depth += 1
+            elif c == closer:
+                depth -= 1
+                if depth == 0:
+                    first = pos
+                    pos = i + 1
+                    return first
+            i = kind_bytes.find(bracket, i + 1, end)
+        return None
+
+    def expect(ty: int, val: Optional[int] = None, vset: Optional[Set[int]] = None, cls: int = 0, check: bool = False) -> Optional[str]:
+        """
+        Takes the next token if it is of kind `ty`, and is the symbol `val`,
+        one of the symbols `vset`, or a keyword of class `cls` where given.
+        Returns its text, or None if it didn't match.
+        """
+        nonlocal pos
+        if pos >= end or kinds[pos] != ty:
             if check:
-                assert False, f"Expected token `{val}`, got {tok[1]}!"
+                raise error(f"Expected token of type `{lexer.kind_names[ty]}`, got {describe(pos)}")
             return None
-        if vset is not None and tok[1] not in vset:
+        sym = syms[pos]
+        if val is not None and sym != val:
             if check:
-                print(f"Expected one of `{', '.join(vset)}`, got {tok[1]}!")
-                exit(-1)
+                raise error(f"Expected token `{names[val]}`, got {describe(pos)}")
             return None
-        if tok[0] != ty:
+        if vset is not None and sym not in vset:
             if check:
-                print(f"Expected token of type `{ty}`, got {tok[0]} `{tok[1]}`!")
-                exit(-1)
+                raise error(f"Expected one of `{', '.join(sorted(names[s] for s in vset))}`, got {describe(pos)}")
+            return None
+        if cls and (sym >= keyword_count or not classes[sym] & cls):
+            if check:
+                raise error(f"Expected one of `{', '.join(sorted(lexer.keywords(cls)))}`, got {describe(pos)}")
             return None
 
-        tok = take()
-        return tok[1]
+        pos += 1
+        return names[sym] if sym else text(pos - 1)
     
     def take_modifiers() -> List[str]:
         modifiers: List[str] = []
         while True:
-            mod = expect("word", vset=modifier_keywords)
+            mod = expect(WORD, cls=MODIFIER)
             if not mod:
                 return modifiers
             modifiers.append(mod)
     
     def take_funcptr() -> Optional[Tuple[Optional[str], List[Type]]]:
-        if not expect("bracket", "("):
+        if not expect(BRACKET, LPAREN):
             return None
         
-        expect("operator", "*", check=True)
-        name = expect("word")
-        expect("bracket", "(", check=True)
-        expect("bracket", ")", check=True)
-        expect("bracket", ")", check=True)
+        expect(OPERATOR, STAR, check=True)
+        name = expect(WORD)
+        expect(BRACKET, LPAREN, check=True)
+        expect(BRACKET, RPAREN, check=True)
+        expect(BRACKET, RPAREN, check=True)
 
         # TODO: function pointer args, array pointers
 
         return name, []
     
-    def expect_expression_unary() -> Expression:
-        op_stack = []
-        while op := expect("operator", vset={"++", "--", "~", "!", "*", "-", "+", "&"}):
-            op_stack.append(op)
-        
-        if expect("bracket", "("):
-            val = expect_expression()
-            expect("bracket", ")", check=True)
-        
-        elif i := expect("integer"):
-            val = Expression.integer(i)
-        
-        elif s := expect("string"):
-            val = Expression.string(s)
+    def expect_expression() -> Expression:
+        """
+        Pratt parsing without recursion: operators still waiting for their
+        right operand, and open `(` and `[`, are kept on an explicit stack,
+        so there is no limit to how deeply an expression can nest.
+        """
+        nonlocal pos
+        # ("infix", left operand, operator, min_bp of the enclosing expression),
+        # ("(", prefix operators, min_bp) or ("[", indexed value, prefix operators, min_bp)
+        waiting = []
+        min_bp = 0
+        while True:
+            prefixes = []
+            while op := expect(OPERATOR, vset=prefix_symbols):
+                prefixes.append(op)
 
-        elif c := expect("char"):
-            val = Expression.char(c)
+            kind = peek()
+            if kind == WORD:
+                val = Expression.variable(expect(WORD))
 
-        elif n := expect("word"):
-            val = Expression.variable(n)
+            elif kind == INTEGER:
+                try:
+                    val = Expression.integer(text(pos))
+                except ValueError:
+                    raise error(f"Invalid integer literal `{text(pos)}`")
+                expect(INTEGER)
 
-        else:
-            assert False, f"unimplemented {peek()} in unary expression"
-        
-        while op := expect("operator", vset={"++", "--", ".", "->"}) or expect("bracket", vset={"[", "("}):
-            if op in {"++", "--"}:
-                val = Expression.postfix(op, val)
-            elif op in {".", "->"}:
-                ident = expect("word", check=True)
-                val = Expression.deconstruct(val, op, ident)
-            elif op == "[":
-                index = expect_expression()
-                expect("bracket", "]", check=True)
-                val = Expression.index(val, index)
-
-        while len(op_stack):
-            op = op_stack.pop()
-            val = Expression.prefix(op, val)
-        return val
-    
-    def expect_expression_inner(opstack: List[Set[str]]):
-        if not len(opstack):
-            return expect_expression_unary()
+            elif kind == STRING:
+                val = Expression.string(expect(STRING))
 
-        top_set = opstack[-1]
-        rest_set = opstack[:-1]
-        
-        val = expect_expression_inner(rest_set)
-        while op := expect("operator", vset=top_set):
-            op2 = expect_expression_inner(rest_set)
-            val = Expression.infix(val, op, op2)
-        
-        return val
-
-    def expect_expression():
-        return expect_expression_inner([
-            {"*", "/", "%"},
-            {"+", "-"},
-            {"<<", ">>"},
-            {"<", "<=", ">=", ">"},
-            {"==", "!="},
-            {"&"},
-            {"^"},
-            {"|"},
-            {"&&"},
-            {"||"},
-            {"=", "+=", "-=", "*=", "/=", "%=", "<<=", ">>=", "&=", "^=", "|="}
-        ])
-        # TODO: ternary, comma
-    
+            elif kind == CHAR:
+                val = Expression.char(expect(CHAR))
 
+            elif expect(BRACKET, LPAREN):
+                waiting.append(("(", prefixes, min_bp))
+                min_bp = 0
+                continue
+
+            else:
+                raise error(f"Expected an expression, got {describe(pos)}")
+
+            # Take what follows the operand until another operand is needed
+            postfix = True
+            while True:
+                op = postfix and (expect(OPERATOR, vset=postfix_symbols) or expect(BRACKET, vset=postfix_bracket_symbols))
+                if op:
+                    if op in {"++", "--"}:
+                        val = Expression.postfix(op, val)
+                    elif op in {".", "->"}:
+                        ident = expect(WORD, check=True)
+                        val = Expression.deconstruct(val, op, ident)
+                    elif op == "[":
+                        waiting.append(("[", val, prefixes, min_bp))
+                        min_bp = 0
+                        break
+                    continue
+
+                while prefixes:
+                    val = Expression.prefix(prefixes.pop(), val)
+
+                if pos < end and kinds[pos] == OPERATOR:
+                    bp = symbol_powers.get(syms[pos])
+                    if bp is not None and bp[0] >= min_bp:
+                        op = names[syms[pos]]
+                        pos += 1
+                        waiting.append(("infix", val, op, min_bp))
+                        min_bp = bp[1]
+                        break
+
+                # `val` is complete: it's the operand of whatever waits for one
+                if not waiting:
+                    return val
+                entry = waiting.pop()
+                if entry[0] == "infix":
+                    _, left, op, min_bp = entry
+                    val = Expression.infix(left, op, val)
+                    # Postfix operators were taken by the right operand
+                    postfix = False
+                elif entry[0] == "(":
+                    _, prefixes, min_bp = entry
+                    expect(BRACKET, RPAREN, check=True)
+                    postfix = True
+                else:
+                    _, indexed, prefixes, min_bp = entry
+                    expect(BRACKET, RSQUARE, check=True)
+                    val = Expression.index(indexed, val)
+                    postfix = True
     
+
     def expect_type() -> Tuple[Type, Optional[str]]:
         typeparts = []
         
-        if tw := expect("word", vset={"signed", "unsigned"}):
+        if tw := expect(WORD, vset={SIGNED, UNSIGNED}):
             typeparts.append(tw)
-            if tw := expect("word", val="long"):
+            if tw := expect(WORD, val=LONG):
                 typeparts.append(tw)
-                if tw := expect("word", vset={"long", "int"}):
+                if tw := expect(WORD, vset={LONG, INT}):
                     typeparts.append(tw)
     
-        elif tw := expect("word", val="long"):
+        elif tw := expect(WORD, val=LONG):
             typeparts.append(tw)
-            if tw := expect("word", vset={"long", "int", "double"}):
+            if tw := expect(WORD, vset={LONG, INT, DOUBLE}):
                 typeparts.append(tw)
         
-        elif tw := expect("word", vset={"struct", "union"}):
+        elif tw := expect(WORD, cls=RECORD):
             typeparts.append(tw)
-            tw = expect("word", check=True)
+            tw = expect(WORD, check=True)
             typeparts.append(tw)
         
-        elif tw := expect("word", check=True):
+        elif tw := expect(WORD, check=True):
             typeparts.append(tw)
         
         basety = Type.value(typeparts)
 
-        while expect("operator", "*"):
+        while expect(OPERATOR, STAR):
             basety = Type.pointer(basety)
 
         funcptr = take_funcptr()
@@ -539,84 +825,134 @@ def parse_toplevel(tokstr: lexer.TokenStream) -> List[Definition]:
             name, args = funcptr
             basety = Type.funcptr(basety, args)
         else:
-            name = expect("word")
+            name = expect(WORD)
 
-        if expect("bracket", "["):
+        if expect(BRACKET, LSQUARE):
             expr = None
-            if not expect("bracket", "]"):
+            if not expect(BRACKET, RSQUARE):
                 expr = expect_expression()
-                expect("bracket", "]", check=True)
+                expect(BRACKET, RSQUARE, check=True)
             basety = Type.array(basety, expr)
 
         return basety, name
     
 
+    def take_attributes(packed: bool, align: Optional[Expression]) -> Tuple[bool, Optional[Expression]]:
+        while expect(WORD, ATTRIBUTE_KEYWORD):
+            expect(BRACKET, LPAREN, check=True)
+            expect(BRACKET, LPAREN, check=True)
+            while True:
+                attr = expect(WORD, cls=ATTRIBUTE, check=True).strip("_")
+                if attr == "packed":
+                    packed = True
+                elif expect(BRACKET, LPAREN):
+                    align = expect_expression()
+                    expect(BRACKET, RPAREN, check=True)
+                else:
+                    # A bare `aligned` means the target's largest alignment
+                    align = Expression.variable("__BIGGEST_ALIGNMENT__")
+                if not expect(DELIMITER, COMMA):
+                    break
+            expect(BRACKET, RPAREN, check=True)
+            expect(BRACKET, RPAREN, check=True)
+        return packed, align
+
+    def take_record() -> Optional[Definition]:
+        nonlocal pos
+        save = pos
+        kind = expect(WORD, cls=RECORD)
+        if not kind:
+            return None
+        packed, align = take_attributes(False, None)
+        name = expect(WORD)
+        if not expect(BRACKET, LBRACE):
+            # Just a struct or union type
+            pos = save
+            return None
+
+        members = []
+        while not expect(BRACKET, RBRACE):
+            take_modifiers()
+            members.append(FunctionParam(*expect_type()))
+            expect(DELIMITER, SEMICOLON, check=True)
+        packed, align = take_attributes(packed, align)
+        expect(DELIMITER, SEMICOLON, check=True)
+        return Definition.record(kind, name, members, packed, align)
+
     def expect_definition() -> Definition:
         mods = take_modifiers()
+        if record := take_record():
+            return record
         ty, name = expect_type()
         val = None
 
-        if expect("bracket", "("):
+        if expect(BRACKET, LPAREN):
             paramtys = []
 
-            if not expect("bracket", ")"):
+            if not expect(BRACKET, RPAREN):
                 paramtys.append(FunctionParam(*expect_type()))
-                while expect("delimiter", ","):
+                while expect(DELIMITER, COMMA):
                     paramtys.append(FunctionParam(*expect_type()))
-                expect("bracket", ")", check=True)
+                expect(BRACKET, RPAREN, check=True)
             
-            if expect("bracket", "{"):
+            if expect(BRACKET, LBRACE):
+                if lazy and (first := skip_body()) is not None:
+                    return Definition.lazy_function(name, ty, paramtys, toks, first, pos)
                 body = expect_body()
                 return Definition.function(name, ty, paramtys, body)
             
             else:
-                expect("delimiter", ";", check=True)
+                expect(DELIMITER, SEMICOLON, check=True)
                 return Definition.function(name, ty, paramtys, None)
 
-        elif expect("operator", "="):
+        elif expect(OPERATOR, ASSIGN):
             val = expect_expression()
         
-        expect("delimiter", ";", check=True)
+        expect(DELIMITER, SEMICOLON, check=True)
         return Definition.value(name, ty, val)
     
     
     def take_control_statement():
-        keyword = expect("word", vset=control_keywords)
+        """
+        A control statement, if one comes next. An `if` or `while` comes back
+        with only its condition, for `expect_body` to give a body.
+        """
+        keyword = expect(WORD, cls=CONTROL)
         if not keyword:
             return None
         
         if keyword == "return":
             exp = expect_expression()        
-            expect("delimiter", ";")
+            expect(DELIMITER, SEMICOLON)
             return Statement.ret(exp)
         elif keyword == "break":
-            expect("delimiter", ";")
+            expect(DELIMITER, SEMICOLON)
             return Statement.brk()
         elif keyword == "goto":
-            ident = expect("word", check=True)
-            expect("delimiter", ";")
+            ident = expect(WORD, check=True)
+            expect(DELIMITER, SEMICOLON)
             return Statement.goto(ident)
         elif keyword == "if":
-            ident = expect("bracket", "(", check=True)
+            ident = expect(BRACKET, LPAREN, check=True)
             expr = expect_expression()
-            expect("bracket", ")", check=True)
-            body = expect_statement()
-            elsebody = None
-            if expect("word", "else"):
-                elsebody = expect_statement()
-            return Statement.ifelse(expr, body, elsebody)
+            expect(BRACKET, RPAREN, check=True)
+            return Statement.ifelse(expr, None, None)
         elif keyword == "while":
-            ident = expect("bracket", "(", check=True)
+            ident = expect(BRACKET, LPAREN, check=True)
             expr = expect_expression()
-            expect("bracket", ")", check=True)
-            body = expect_statement()
-            return Statement.whileloop(expr, body)
+            expect(BRACKET, RPAREN, check=True)
+            return Statement.whileloop(expr, None)
         else:
-            assert(not "unimplemented")
+            raise error(f"`{keyword}` statements are not supported")
 
     def expect_statement():
-        if expect("bracket", "{"):
-            return Statement.block(expect_body());
+        """
+        The next statement, or the start of one that holds others: a new
+        block's (empty) list of statements, or an `if` or `while` without
+        its body yet.
+        """
+        if expect(BRACKET, LBRACE):
+            return []
 
         if control := take_control_statement():
             return control
@@ -626,34 +962,187 @@ def parse_toplevel(tokstr: lexer.TokenStream) -> List[Definition]:
             defn = expect_definition()
             return Statement.definition(defn)
         
-        w1, w2 = peek(n=2)
-        if w1[0] == "word" and w2[0] == "word":
+        if peek() == WORD and peek(1) == WORD:
             # Variable declaration and assignment
             defn = expect_definition()
             return Statement.definition(defn)
         
         expr = expect_expression()
-        expect("delimiter", ";", check=True)
+        expect(DELIMITER, SEMICOLON, check=True)
         return Statement.expression(expr)
 
     
     def expect_body():
+        """
+        The statements of a body whose `{` was taken, up to its `}`. Nested
+        statements are parsed with an explicit stack rather than recursion,
+        so no `else if` chain or nesting of blocks is too deep.
+        """
         stmts = []
-        while not expect("bracket", "}"):
-            stmt = expect_statement()
-            stmts.append(stmt)
-        return stmts
-    
-    defns = []
-    while not done():
-        defns.append(expect_definition())
-    return defns
-    
+        # The statements of every unclosed block, and every `if` and `while`
+        # waiting for a body, innermost last
+        stack = [stmts]
+        while True:
+            top = stack[-1]
+            if type(top) is list and expect(BRACKET, RBRACE):
+                stack.pop()
+                if not stack:
+                    return stmts
+                stmt = Statement.block(top)
+            else:
+                if type(top) is list and done():
+                    raise error("Expected token `}`, got end of input")
+                try:
+                    stmt = expect_statement()
+                except ParseError as e:
+                    # Errors at the end of input go to the top, where they're reported once
+                    if errors is None or done():
+                        raise
+                    errors.append(e.diagnostic)
+                    recover(True)
+                    # Whatever the broken statement was part of goes with it
+                    while type(stack[-1]) is not list:
+                        stack.pop()
+                    continue
+                if type(stmt) is list or (stmt.storage in (Statement.IF, Statement.WHILE) and stmt.body is None):
+                    stack.append(stmt)
+                    continue
+
+            # Hand the statement to what holds it, and so on up while that
+            # completes an `if` or `while`
+            while True:
+                holder = stack[-1]
+                if type(holder) is list:
+                    holder.append(stmt)
+                    break
+                if holder.body is None:
+                    holder.body = stmt
+                    if holder.storage == Statement.IF and expect(WORD, ELSE):
+                        break
+                else:
+                    holder.body_else = stmt
+                stmt = stack.pop()
+
+    def take_definition() -> Optional[Definition]:
+        """The next top-level definition, or None if it was broken and skipped."""
+        try:
+            return expect_definition()
+        except ParseError as e:
+            if errors is None:
+                raise
+            errors.append(e.diagnostic)
+            recover(False)
+            return None
+
+    def definitions() -> Iterator[Definition]:
+        while not done():
+            if (defn := take_definition()) is not None:
+                yield defn
 
-file = "test.c"
-with open(file) as input:
-    input = input.read()
-    tokstr = lexer.tokenize(file, input)
-    ast = parse_toplevel(tokstr)
-    print("\n".join(map(str, ast)))
+    def whole_expression() -> Expression:
+        e = expect_expression()
+        if not done():
+            raise error(f"Expected end of expression, got {describe(pos)}")
+        return e
 
+    if stats is None:
+        return definitions, expect_body, whole_expression
+
+    # Only an instrumented parse goes through the wrappers
+    position = lambda: pos
+    expect = stats.wrap_expect(expect)
+    peek = stats.wrap_peek(peek)
+    (
+        take_modifiers, take_funcptr, expect_expression, expect_type, take_attributes,
+        take_record, expect_definition, take_control_statement, expect_statement, expect_body,
+    ) = (stats.wrap_production(fn, position) for fn in (
+        take_modifiers, take_funcptr, expect_expression, expect_type, take_attributes,
+        take_record, expect_definition, take_control_statement, expect_statement, expect_body,
+    ))
+    return (lambda: stats.toplevel(take_definition, done, position)), expect_body, whole_expression
+
+
+def toplevel_spans(toks: lexer.TokenBuffer, start: int = 0, stop: Optional[int] = None) -> Tuple[List[Tuple[int, int]], int]:
+    """
+    Splits tokens into top-level definitions by bracket depth alone: a
+    definition ends at a `;` or a closing `}` at depth 0, except that struct
+    and union bodies (a `{` after a word) run on to their `;`. Returns the token
+    range of every complete definition, and the index at which the
+    unterminated remainder (if any) begins.
+    """
+    kinds = toks.kinds
+    starts = toks.starts
+    source = toks.source
+    stop = len(kinds) if stop is None else stop
+
+    # Indexing bytes gives ints, so compare against the matching kind of value
+    if isinstance(source, str):
+        openers, opener, closer, semicolon = "([{", "{", "}", ";"
+    else:
+        openers, opener, closer, semicolon = b"([{", ord("{"), ord("}"), ord(";")
+
+    spans = []
+    depth = 0
+    first = start
+    record = False
+    for i in range(start, stop):
+        kind = kinds[i]
+        if kind == BRACKET:
+            c = source[starts[i]]
+            if c in openers:
+                if depth == 0 and c == opener and i > first and kinds[i - 1] == WORD:
+                    record = True
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0 and c == closer and not record:
+                    spans.append((first, i + 1))
+                    first = i + 1
+        elif kind == DELIMITER and depth == 0 and source[starts[i]] == semicolon:
+            spans.append((first, i + 1))
+            first = i + 1
+            record = False
+    return spans, first
+
+
+def scan_file(file: str, mapped: bool = False) -> lexer.TokenBuffer:
+    if mapped:
+        return lexer.TokenBuffer.map_file(file)
+    with open(file) as input:
+        return lexer.TokenBuffer.scan(file, input.read())
+
+
+def parse_file(file: str, mapped: bool = False, lazy: bool = False, errors: Optional[List[Diagnostic]] = None) -> List[Definition]:
+    return parse_toplevel(scan_file(file, mapped), lazy=lazy, errors=errors)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    import printer
+    import sys
+
+    args = sys.argv[1:] if argv is None else list(argv)
+    stats = None
+    if "--stats" in args:
+        from instrument import Stats
+        args.remove("--stats")
+        stats = Stats()
+
+    errors: List[Diagnostic] = []
+    for file in args or ["test.c"]:
+        with open(file) as input:
+            toks = lexer.TokenBuffer.scan(file, input.read()) if stats is None else stats.scan(file, input.read())
+        printer.write(parse_iter(toks, stats=stats, errors=errors), sys.stdout)
+    for diagnostic in errors:
+        print(diagnostic, file=sys.stderr)
+    if stats is not None:
+        stats.report(sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    # Run the imported `parser` rather than this `__main__` copy of it, so
+    # nodes have the same classes (and Type the same interning table) as
+    # the ones every other module sees
+    import parser
+    import sys
+    sys.exit(parser.main())
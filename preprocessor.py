@@ -0,0 +1,640 @@
+import argparse
+import lexer
+import os
+import printer
+import re
+import sys
+
+from array import array
+from bisect import bisect_left, bisect_right
+from lexer import CHAR, INTEGER, STRING, WORD, TokenBuffer, symbols
+from parser import COMMA, LPAREN, RPAREN, Diagnostic, Expression, ParseError, parse_expression, parse_iter
+from typeck import evaluate
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+# A token outside of any source: kind, symbol and text
+Tok = Tuple[int, int, str]
+# A token being expanded, with the symbols of the macros it came out of
+Hidden = Tuple[Tok, FrozenSet[int]]
+no_macros: FrozenSet[int] = frozenset()
+
+# A directive line, with any lines joined onto it by a trailing `\`. The
+# lexer has no `#` token: it skips the `#` as an unknown character, so the
+# directive's name comes out as its first token.
+directive_line = re.compile(r"^[ \t]*#[ \t]*(\w*)((?:[^\n\\]|\\.)*)", re.M | re.S)
+include_target = re.compile(r"\s*(?:\"([^\"]*)\"|<([^>]*)>)")
+
+DEFINED = symbols.intern("defined")
+DOT = symbols.intern(".")
+VA_ARGS = "__VA_ARGS__"
+# The separator of joined variadic arguments
+comma: Tok = (lexer.DELIMITER, COMMA, ",")
+
+conditionals = {"if", "ifdef", "ifndef", "elif", "else", "endif"}
+max_include_depth = 200
+
+
+def token(toks: TokenBuffer, i: int) -> Tok:
+    return toks.kinds[i], toks.syms[i], toks.text(i)
+
+
+def number(value: int) -> Tok:
+    return INTEGER, 0, str(value)
+
+
+# The largest intmax_t, which is long long under every data model
+intmax_max = (1 << 63) - 1
+
+
+def widened(text: str) -> str:
+    """
+    An `#if` literal, suffixed so that it has an intmax_t or uintmax_t type:
+    `ll`, or `ull` if it had a `u` or its value doesn't fit in intmax_t.
+    """
+    digits = text.rstrip("luLU")
+    unsigned = "u" in text[len(digits):].lower()
+    try:
+        unsigned = unsigned or Expression.integer(text).intval > intmax_max
+    except ValueError:
+        # Left for the parser to report
+        return text
+    return digits + ("ull" if unsigned else "ll")
+
+
+class SourceFile:
+    """
+    A file lexed once, and split into runs of ordinary tokens and directives.
+    `items` holds (directive name, first token, stop token, offset, rest of
+    the line) for directives, whose tokens leave out the name, and (None,
+    first token, stop token, 0, "") for the runs in between.
+
+    `guard` is the symbol of the macro a classic include guard tests for,
+    when the whole file is wrapped in `#ifndef X` / `#define X` ... `#endif`,
+    and `once` tells whether the file has a `#pragma once`.
+    """
+
+    __slots__ = ("path", "toks", "items", "guard", "once", "stamp")
+
+    def __init__(self, path: str, source: str, stamp: Optional[Tuple[int, int]] = None):
+        self.path = path
+        self.toks = toks = TokenBuffer.scan(path, source)
+        self.stamp = stamp
+        self.items: List[Tuple[Optional[str], int, int, int, str]] = []
+        starts = toks.starts
+        pos = 0
+        for match in directive_line.finditer(source):
+            first = bisect_left(starts, match.start(), pos)
+            stop = bisect_left(starts, match.end(), first)
+            if first > pos:
+                self.items.append((None, pos, first, 0, ""))
+            name = match[1]
+            self.items.append((name, first + 1 if name else first, stop, match.start(), match[2]))
+            pos = stop
+        if pos < len(toks):
+            self.items.append((None, pos, len(toks), 0, ""))
+
+        self.once = any(name == "pragma" and rest.split()[:1] == ["once"] for name, _, _, _, rest in self.items)
+        self.guard = self.include_guard()
+
+    def include_guard(self) -> Optional[int]:
+        items = [item for item in self.items if item[0] is not None or item[2] > item[1]]
+        if len(items) < 3 or items[0][0] != "ifndef" or items[1][0] != "define" or items[-1][0] != "endif":
+            return None
+        (_, first, stop, _, _), (_, define, define_stop, _, _) = items[0], items[1]
+        syms = self.toks.syms
+        if stop - first != 1 or define == define_stop or syms[first] != syms[define]:
+            return None
+        # The #endif at the end has to be the one closing the #ifndef at the start
+        depth = 0
+        for name, _, _, _, _ in items[:-1]:
+            if name in ("if", "ifdef", "ifndef"):
+                depth += 1
+            elif name == "endif":
+                depth -= 1
+                if depth == 0:
+                    return None
+        return syms[first]
+
+    @staticmethod
+    def read(path: str) -> 'SourceFile':
+        with open(path) as input:
+            stat = os.fstat(input.fileno())
+            return SourceFile(path, input.read(), (stat.st_mtime_ns, stat.st_size))
+
+
+# Every header read so far, by real path, kept for the rest of the process
+file_cache: Dict[str, SourceFile] = {}
+
+
+def load(path: str) -> SourceFile:
+    """The SourceFile of a header, lexed the first time it is asked for, and again only if it changed on disk."""
+    unit = file_cache.get(path)
+    if unit is not None:
+        stat = os.stat(path)
+        if unit.stamp == (stat.st_mtime_ns, stat.st_size):
+            return unit
+    unit = file_cache[path] = SourceFile.read(path)
+    return unit
+
+
+class Macro:
+    """
+    A `#define`. `params` maps parameter names to their index, and is None
+    for object-like macros. `ops` gives, for each token of `body`, the `#`
+    or `##` in front of it, if any.
+    """
+
+    __slots__ = ("name", "params", "variadic", "body", "ops")
+
+    def __init__(self, name: str, params: Optional[Dict[str, int]], variadic: bool, body: List[Tok], ops: List[str]):
+        self.name = name
+        self.params = params
+        self.variadic = variadic
+        self.body = body
+        self.ops = ops
+
+
+class Output:
+    """
+    Builds the token buffer that goes to the parser. Runs of tokens copied
+    from a file keep their text and layout; tokens made by macro expansion
+    are spelled out one after another. `origins` remembers where each piece
+    came from, so offsets can be mapped back to the files.
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        self.parts: List[str] = []
+        self.length = 0
+        self.kinds = array("B")
+        self.starts = array("Q")
+        self.lengths = array("I")
+        self.syms = array("I")
+        # (output offset, file, offset in the file, whether the piece is a copy)
+        self.origins: List[Tuple[int, SourceFile, int, bool]] = []
+
+    def copy(self, unit: SourceFile, first: int, stop: int):
+        if first >= stop:
+            return
+        toks = unit.toks
+        begin, end = toks.starts[first], toks.end(stop - 1)
+        delta = self.length - begin
+        self.origins.append((self.length, unit, begin, True))
+        self.kinds.extend(toks.kinds[first:stop])
+        # The file's columns may be narrower than these
+        self.syms.fromlist(toks.syms[first:stop].tolist())
+        self.starts.extend(start + delta for start in toks.starts[first:stop])
+        self.lengths.fromlist(toks.lengths[first:stop].tolist())
+        self.parts.append(toks.source[begin:end])
+        self.parts.append("\n")
+        self.length += end - begin + 1
+
+    def extend(self, tokens: Iterable[Tok], unit: Optional[SourceFile] = None, offset: int = 0):
+        if unit is not None:
+            self.origins.append((self.length, unit, offset, False))
+        for kind, sym, text in tokens:
+            self.kinds.append(kind)
+            self.syms.append(sym)
+            self.starts.append(self.length)
+            self.lengths.append(len(text))
+            self.length += len(text)
+            self.parts.append(text)
+            self.parts.append(" ")
+            self.length += 1
+
+    def finish(self) -> TokenBuffer:
+        toks = TokenBuffer(self.file, "".join(self.parts))
+        toks.kinds = self.kinds
+        toks.starts = array(toks.starts.typecode, self.starts)
+        toks.lengths = self.lengths
+        toks.syms = self.syms
+        return toks
+
+
+class Preprocessor:
+    """
+    Runs the directives of a translation unit and expands its macros,
+    between the lexer and `parse_toplevel`. Supports `#include`, object-
+    and function-like `#define` (with `#`, `##` and `__VA_ARGS__`),
+    `#undef`, `#if`/`#ifdef`/`#ifndef`/`#elif`/`#else`/`#endif` and
+    `#error`. `#if` expressions are evaluated like constant expressions in
+    `typeck`, after `defined` and macros are replaced; names that are left
+    count as 0.
+
+    Headers come from `file_cache`, so each one is lexed once per process
+    however many translation units include it. A header with a `#pragma
+    once` that was already included, or one whose include guard macro is
+    defined, is skipped without looking at its tokens again.
+
+    Errors raise ParseError, unless an `errors` list is given: then they are
+    added to it and the directive is ignored.
+    """
+
+    def __init__(self, include_paths: Iterable[str] = (), defines: Optional[Dict[str, str]] = None,
+                 errors: Optional[List[Diagnostic]] = None):
+        self.include_paths = list(include_paths)
+        self.errors = errors
+        self.macros: Dict[int, Macro] = {}
+        # Real paths of the `#pragma once` headers already included
+        self.once: Set[str] = set()
+        self.depth = 0
+        # Includes skipped for `#pragma once` or their include guard
+        self.skipped = 0
+        self.output = Output("")
+        # The file and offset that errors in macro expansion are reported at
+        self.location: Tuple[SourceFile, int] = (SourceFile("<none>", ""), 0)
+        for name, value in (defines or {}).items():
+            self.define(name, value)
+
+    def define(self, name: str, value: str = "1"):
+        """Defines a macro as if by `#define name value`, e.g. for `-D`."""
+        self.process(SourceFile("<command line>", f"#define {name} {value}\n"))
+
+    def run(self, file: str) -> TokenBuffer:
+        """Preprocesses `file` into a token buffer for the parser."""
+        self.output = Output(file)
+        self.process(SourceFile.read(file))
+        return self.output.finish()
+
+    def locate(self, diagnostic: Diagnostic) -> Diagnostic:
+        """
+        Moves a diagnostic about the output to where its token came from: the
+        same place in a file, or the macro that was expanded into it.
+        """
+        origins = self.output.origins
+        i = bisect_right(origins, diagnostic.offset, key=lambda origin: origin[0]) - 1
+        if i < 0:
+            return diagnostic
+        begin, unit, offset, copied = origins[i]
+        if copied:
+            offset += diagnostic.offset - begin
+        return Diagnostic.at(unit.toks, offset, diagnostic.message)
+
+    def error(self, unit: SourceFile, offset: int, message: str):
+        diagnostic = Diagnostic.at(unit.toks, offset, message)
+        if self.errors is None:
+            raise ParseError(diagnostic)
+        self.errors.append(diagnostic)
+
+    def process(self, unit: SourceFile):
+        # [whether the enclosing group is kept, whether this branch is, whether any branch was]
+        conds: List[List[bool]] = []
+        active = True
+        for name, first, stop, offset, rest in unit.items:
+            if name is None:
+                if active:
+                    self.text(unit, first, stop)
+            elif name in conditionals:
+                self.conditional(unit, conds, name, first, stop, offset, active)
+                active = conds[-1][1] if conds else True
+            elif not active:
+                continue
+            elif name == "define":
+                self.take_define(unit, first, stop, offset)
+            elif name == "undef":
+                if first < stop:
+                    self.macros.pop(unit.toks.syms[first], None)
+            elif name == "include":
+                self.include(unit, offset, rest)
+            elif name == "error":
+                self.error(unit, offset, f"#error{rest.rstrip()}")
+            elif name not in ("", "pragma", "line", "warning"):
+                self.error(unit, offset, f"Unknown directive `#{name}`")
+        if conds:
+            self.error(unit, len(unit.toks.source), "Expected `#endif`, got end of file")
+
+    def conditional(self, unit: SourceFile, conds: List[List[bool]], name: str, first: int, stop: int, offset: int, active: bool):
+        syms = unit.toks.syms
+        if name in ("if", "ifdef", "ifndef"):
+            if not active:
+                taken = False
+            elif name == "if":
+                taken = self.condition(unit, first, stop, offset)
+            elif first == stop:
+                self.error(unit, offset, f"Expected a macro name after `#{name}`")
+                taken = False
+            else:
+                taken = (syms[first] in self.macros) == (name == "ifdef")
+            conds.append([active, taken, taken])
+        elif not conds:
+            self.error(unit, offset, f"`#{name}` without `#if`")
+        elif name == "elif":
+            cond = conds[-1]
+            cond[1] = cond[0] and not cond[2] and self.condition(unit, first, stop, offset)
+            cond[2] = cond[2] or cond[1]
+        elif name == "else":
+            cond = conds[-1]
+            cond[1] = cond[0] and not cond[2]
+            cond[2] = True
+        else:
+            conds.pop()
+
+    def condition(self, unit: SourceFile, first: int, stop: int, offset: int) -> bool:
+        toks = [token(unit.toks, i) for i in range(first, stop)]
+        # `defined` is resolved before anything is expanded
+        resolved: List[Tok] = []
+        i = 0
+        while i < len(toks):
+            if toks[i][1] != DEFINED:
+                resolved.append(toks[i])
+                i += 1
+                continue
+            paren = i + 1 < len(toks) and toks[i + 1][1] == LPAREN
+            i += 1 + paren
+            if i >= len(toks) or toks[i][0] != WORD or (paren and (i + 1 >= len(toks) or toks[i + 1][1] != RPAREN)):
+                self.error(unit, offset, "Expected a macro name after `defined`")
+                return False
+            resolved.append(number(int(toks[i][1] in self.macros)))
+            i += 1 + paren
+
+        self.location = unit, offset
+        tokens = []
+        for kind, sym, text in self.expand(resolved):
+            if kind == WORD:
+                tokens.append(number(0))
+            elif kind == INTEGER:
+                tokens.append((kind, sym, widened(text)))
+            else:
+                tokens.append((kind, sym, text))
+        if not tokens:
+            self.error(unit, offset, "Expected an expression after `#if`")
+            return False
+
+        out = Output(unit.path)
+        out.extend(tokens)
+        try:
+            value = evaluate(parse_expression(out.finish()))
+        except ParseError as e:
+            self.error(unit, offset, f"Invalid `#if` expression: {e.diagnostic.message}")
+            return False
+        if value is None:
+            self.error(unit, offset, "`#if` expression is not constant")
+            return False
+        return value[0] != 0
+
+    def take_define(self, unit: SourceFile, first: int, stop: int, offset: int):
+        toks = unit.toks
+        if first == stop or toks.kinds[first] != WORD:
+            self.error(unit, offset, "Expected a macro name after `#define`")
+            return
+        name = first
+        i = first + 1
+        params = None
+        variadic = False
+        # It's only a parameter list if the `(` comes right after the name
+        if i < stop and toks.syms[i] == LPAREN and toks.starts[i] == toks.end(name):
+            params = {}
+            i += 1
+            while i < stop and toks.syms[i] != RPAREN:
+                if toks.syms[i] == DOT and i + 2 < stop and toks.syms[i + 1] == toks.syms[i + 2] == DOT:
+                    params[VA_ARGS] = len(params)
+                    variadic = True
+                    i += 3
+                elif toks.kinds[i] == WORD and not variadic:
+                    params[toks.text(i)] = len(params)
+                    i += 1
+                else:
+                    self.error(unit, toks.starts[i], f"Unexpected `{toks.text(i)}` in macro parameters")
+                    return
+                if i < stop and toks.syms[i] == COMMA:
+                    i += 1
+            if i == stop:
+                self.error(unit, offset, "Expected `)` after macro parameters")
+                return
+            i += 1
+
+        body = [token(toks, j) for j in range(i, stop)]
+        ops = []
+        # `#` and `##` are dropped by the lexer, but can still be seen between the tokens
+        for j in range(i, stop):
+            gap = toks.source[toks.end(j - 1):toks.starts[j]]
+            ops.append("##" if "##" in gap else "#" if "#" in gap else "")
+        self.macros[toks.syms[name]] = Macro(toks.text(name), params, variadic, body, ops)
+
+    def find(self, unit: SourceFile, name: str, quoted: bool) -> Optional[str]:
+        if os.path.isabs(name):
+            return name if os.path.isfile(name) else None
+        dirs = self.include_paths
+        if quoted:
+            dirs = [os.path.dirname(unit.path)] + dirs
+        for dir in dirs:
+            path = os.path.join(dir, name)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def include(self, unit: SourceFile, offset: int, rest: str):
+        match = include_target.match(rest)
+        if match is None:
+            self.error(unit, offset, "Expected \"file\" or <file> after `#include`")
+            return
+        path = self.find(unit, match[1] if match[1] is not None else match[2], match[1] is not None)
+        if path is None:
+            self.error(unit, offset, f"Cannot find include file `{match[1] or match[2]}`")
+            return
+        if self.depth >= max_include_depth:
+            self.error(unit, offset, "`#include` nested too deeply")
+            return
+
+        path = os.path.realpath(path)
+        if path in self.once:
+            self.skipped += 1
+            return
+        header = load(path)
+        if header.guard is not None and header.guard in self.macros:
+            self.skipped += 1
+            return
+        if header.once:
+            self.once.add(path)
+        self.depth += 1
+        try:
+            self.process(header)
+        finally:
+            self.depth -= 1
+
+    def text(self, unit: SourceFile, first: int, stop: int):
+        """Copies tokens to the output, expanding macros on the way."""
+        out = self.output
+        macros = self.macros
+        if not macros:
+            out.copy(unit, first, stop)
+            return
+        toks = unit.toks
+        syms = toks.syms
+        run = i = first
+        while i < stop:
+            # Only words are ever macros, and no macro has symbol 0
+            if syms[i] not in macros:
+                i += 1
+                continue
+            out.copy(unit, run, i)
+            end = i + 1
+
+            def pull() -> Optional[Tok]:
+                nonlocal end
+                if end == stop:
+                    return None
+                end += 1
+                return token(toks, end - 1)
+
+            self.location = unit, toks.starts[i]
+            expanded = self.rescan([(token(toks, i), no_macros)], pull)
+            out.extend((tok for tok, _ in expanded), unit, toks.starts[i])
+            run = i = end
+        out.copy(unit, run, stop)
+
+    def expand(self, tokens: List[Tok]) -> List[Tok]:
+        """Expands the macros in `tokens`, with nothing after them to take arguments from."""
+        return [tok for tok, _ in self.rescan([(tok, no_macros) for tok in reversed(tokens)])]
+
+    def rescan(self, pending: List[Hidden], pull: Optional[Callable[[], Optional[Tok]]] = None) -> List[Hidden]:
+        """
+        Expands the macros in `pending`, a stack with the next token on top.
+        Each token carries the macros it came out of, which are never
+        expanded in it again. An expansion goes back on the stack, so it is
+        rescanned together with the tokens after it, and a call's `(...)`
+        can run on past the stack into the input `pull` gives.
+        """
+        macros = self.macros
+        out: List[Hidden] = []
+
+        def take() -> Optional[Hidden]:
+            if pending:
+                return pending.pop()
+            tok = pull() if pull is not None else None
+            return None if tok is None else (tok, no_macros)
+
+        while pending:
+            tok, hide = pending.pop()
+            sym = tok[1]
+            macro = macros.get(sym)
+            if macro is None or sym in hide:
+                out.append((tok, hide))
+                continue
+            if macro.params is None:
+                pending.extend(reversed(self.substitute(macro, None, hide | {sym})))
+                continue
+
+            paren = take()
+            if paren is None or paren[0][1] != LPAREN:
+                # A function-like macro's name without a call is just a name
+                if paren is not None:
+                    pending.append(paren)
+                out.append((tok, hide))
+                continue
+            args: List[List[Hidden]] = [[]]
+            depth = 0
+            while (arg := take()) is not None:
+                arg_sym = arg[0][1]
+                if arg_sym == RPAREN and depth == 0:
+                    break
+                if arg_sym == COMMA and depth == 0:
+                    args.append([])
+                    continue
+                depth += (arg_sym == LPAREN) - (arg_sym == RPAREN)
+                args[-1].append(arg)
+            if arg is None:
+                self.error(*self.location, f"Unterminated call of macro `{macro.name}`")
+                continue
+            bound = self.bind(macro, args)
+            if bound is not None:
+                # Only macros hidden in both the name and the `)` stay hidden (C11 6.10.3.4)
+                pending.extend(reversed(self.substitute(macro, bound, (hide & arg[1]) | {sym})))
+        return out
+
+    def bind(self, macro: Macro, args: List[List[Hidden]]) -> Optional[List[List[Hidden]]]:
+        """Matches a call's arguments up with the macro's parameters."""
+        count = len(macro.params)
+        if count == 0 and args == [[]]:
+            return []
+        if macro.variadic and len(args) >= count:
+            joined = args[count - 1]
+            for arg in args[count:]:
+                joined = joined + [(comma, no_macros)] + arg
+            return args[:count - 1] + [joined]
+        if macro.variadic and len(args) == count - 1:
+            return args + [[]]
+        if len(args) != count:
+            self.error(*self.location, f"Macro `{macro.name}` takes {count} arguments, got {len(args)}")
+            return None
+        return args
+
+    def substitute(self, macro: Macro, args: Optional[List[List[Hidden]]], hide: FrozenSet[int]) -> List[Hidden]:
+        """The replacement list of a call, every token of it hiding `hide` as well."""
+        params = macro.params or {}
+        body, ops = macro.body, macro.ops
+        expanded: Dict[int, List[Hidden]] = {}
+        out: List[Hidden] = []
+        for i, tok in enumerate(body):
+            op = ops[i]
+            param = params.get(tok[2]) if tok[0] == WORD else None
+            if param is None:
+                pieces = [(tok, hide)]
+            elif op == "#":
+                out.append((stringize([arg for arg, _ in args[param]]), hide))
+                continue
+            else:
+                if op == "##" or (i + 1 < len(body) and ops[i + 1] == "##"):
+                    # Operands of `##` are pasted as they were written
+                    arg = args[param]
+                else:
+                    if param not in expanded:
+                        expanded[param] = self.rescan(args[param][::-1])
+                    arg = expanded[param]
+                pieces = [(arg_tok, arg_hide | hide) for arg_tok, arg_hide in arg]
+            if op == "##" and out and pieces:
+                pieces = [(pasted, hide) for pasted in self.paste(out.pop()[0], pieces[0][0])] + pieces[1:]
+            out.extend(pieces)
+        return out
+
+    def paste(self, a: Tok, b: Tok) -> List[Tok]:
+        text = a[2] + b[2]
+        toks = TokenBuffer.scan("", text)
+        if len(toks) != 1 or toks.lengths[0] != len(text):
+            self.error(*self.location, f"Pasting `{a[2]}` and `{b[2]}` does not give a valid token")
+            return [a, b]
+        return [(toks.kinds[0], toks.syms[0], text)]
+
+
+def stringize(arg: List[Tok]) -> Tok:
+    spelled = " ".join(
+        text.replace("\\", "\\\\").replace("\"", "\\\"") if kind in (STRING, CHAR) else text
+        for kind, _, text in arg
+    )
+    return STRING, 0, f"\"{spelled}\""
+
+
+def preprocess_file(file: str, include_paths: Iterable[str] = (), defines: Optional[Dict[str, str]] = None,
+                    errors: Optional[List[Diagnostic]] = None) -> TokenBuffer:
+    return Preprocessor(include_paths, defines, errors).run(file)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argparser = argparse.ArgumentParser(description="Preprocess and parse C files.")
+    argparser.add_argument("files", nargs="+")
+    argparser.add_argument("-I", dest="include_paths", action="append", default=[], metavar="DIR", help="add a directory to search for headers")
+    argparser.add_argument("-D", dest="defines", action="append", default=[], metavar="NAME[=VALUE]", help="define a macro")
+    argparser.add_argument("-E", dest="preprocess_only", action="store_true", help="print the preprocessed tokens instead of the AST")
+    args = argparser.parse_args(argv)
+
+    defines = dict((define.split("=", 1) + ["1"])[:2] for define in args.defines)
+    errors: List[Diagnostic] = []
+    skipped = 0
+    for file in args.files:
+        pp = Preprocessor(args.include_paths, defines, errors)
+        toks = pp.run(file)
+        if args.preprocess_only:
+            sys.stdout.write(toks.source)
+        else:
+            parse_errors: List[Diagnostic] = []
+            printer.write(parse_iter(toks, errors=parse_errors), sys.stdout)
+            errors.extend(map(pp.locate, parse_errors))
+        skipped += pp.skipped
+    for diagnostic in errors:
+        print(diagnostic, file=sys.stderr)
+    print(f"{len(file_cache)} headers lexed, {skipped} includes skipped", file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
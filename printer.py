@@ -0,0 +1,175 @@
+from parser import Type, FunctionParam, Definition, Expression, Statement
+from typing import Dict, Iterable, List, TextIO
+from visitor import Visitor
+
+
+class Printer(Visitor):
+    """
+    Writes AST nodes to a file-like object in the same format as their
+    `__str__`, without building the whole string first. Pieces are collected
+    and handed to `out` in chunks of about `chunk_size` pieces. Nodes are
+    walked without recursion, so the depth of a tree doesn't matter.
+    """
+
+    def __init__(self, out: TextIO, indent: str = "    ", chunk_size: int = 4096):
+        super().__init__()
+        self.out = out
+        self.indent = indent
+        self.chunk_size = chunk_size
+        self.parts: List[str] = []
+        self.pieces = {
+            Type: self.type,
+            FunctionParam: self.param,
+            Definition: self.definition,
+            Expression: self.expression,
+            Statement: self.statement,
+        }
+        self.types: Dict[Type, str] = {}
+        # Pieces of the tree being walked go out in chunks as well, so even
+        # one huge definition is never held whole
+        self.text = self.write
+
+    def write(self, text: str):
+        self.parts.append(text)
+        if len(self.parts) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        self.out.write("".join(self.parts))
+        self.parts.clear()
+
+    def children(self, node) -> List:
+        return self.pieces[type(node)](node)
+
+    # Each of these gives the text of a node as a list of strings, with the
+    # children to print in between. Types and leaf expressions are turned
+    # into text on the spot rather than walked; a tree is mostly those.
+
+    def type(self, t: Type) -> List:
+        if t.storage == Type.POINTER:
+            return ["Type *{", t.pointee, "}"]
+        elif t.storage == Type.VALUE:
+            return ["Type {" + " ".join(map(str, t.val)) + "}"]
+        elif t.storage == Type.FUNCPTR:
+            return [f"Type fn({t.paramtys}) -> {{", t.outty, "})"]
+        elif t.storage == Type.ARRAY:
+            return ["Type {", t.pointee, "}[", or_none(t.size), "]"]
+        return []
+
+    def type_text(self, t: Type) -> str:
+        # Types are interned, so there are few of them
+        text = self.types.get(t)
+        if text is None:
+            text = self.types[t] = to_string(t)
+        return text
+
+    def leaf(self, e: Expression):
+        """The text of `e` if it has no subexpressions, else `e` itself."""
+        if e.storage == Expression.VARIABLE:
+            return f"(Var {e.varname})"
+        elif e.storage == Expression.INTEGER:
+            return f"({self.type_text(e.ty)} {e.intval})"
+        elif e.storage == Expression.STRING:
+            return f"\"{e.strval}\""
+        return e
+
+    def param(self, p: FunctionParam) -> List:
+        return [f"Param {p.name}: {self.type_text(p.ty)}"]
+
+    def expression(self, e: Expression) -> List:
+        leaf = self.leaf
+        if e.storage == Expression.PREFIX:
+            return [f"({e.op} ", leaf(e.exp1), ")"]
+        elif e.storage == Expression.POSTFIX:
+            return ["(", leaf(e.exp1), f" {e.op})"]
+        elif e.storage == Expression.INFIX:
+            return ["(", leaf(e.exp1), f" {e.op} ", leaf(e.exp2), ")"]
+        elif e.storage == Expression.DECONSTRUCT:
+            return ["(", leaf(e.exp1), f" {e.op} {e.ident})"]
+        elif e.storage == Expression.INDEX:
+            return ["(", leaf(e.exp1), " [ ", leaf(e.exp2), " ])"]
+        return [leaf(e)]
+
+    def statement(self, s: Statement) -> List:
+        if s.storage == Statement.DEFINITION:
+            return [s.defn]
+        elif s.storage == Statement.BLOCK:
+            items = ["{ "]
+            for i, inner in enumerate(s.blk):
+                if i:
+                    items.append("\n")
+                items.append(inner)
+            items.append(" }")
+            return items
+        elif s.storage == Statement.EXPRESSION:
+            return ["Apply ", self.leaf(s.val)]
+        elif s.storage == Statement.RETURN:
+            return ["Return ", "None" if s.val is None else self.leaf(s.val)]
+        elif s.storage == Statement.GOTO:
+            return [f"Goto {s.ident}"]
+        elif s.storage == Statement.BREAK:
+            return ["Break"]
+        elif s.storage == Statement.IF:
+            items = ["If ", self.leaf(s.val), " ", s.body]
+            if s.body_else is not None:
+                items += [" Else ", s.body_else]
+            return items
+        elif s.storage == Statement.WHILE:
+            return ["While ", self.leaf(s.val), " ", s.body]
+        return []
+
+    def definition(self, d: Definition) -> List:
+        if d.storage == Definition.VALUE:
+            if d.val is not None:
+                return [f"Define {d.name}: {{{self.type_text(d.ty)}}} = ", self.leaf(d.val)]
+            return [f"Declare {d.name}: {{{self.type_text(d.ty)}}}"]
+
+        elif d.storage == Definition.FUNCTION:
+            items = [f"Define fn {d.name}(" if d.body is not None else f"Declare fn {d.name}("]
+            for i, param in enumerate(d.paramtys):
+                if i:
+                    items.append(", ")
+                items.append(f"Param {param.name}: {self.type_text(param.ty)}")
+            items.append(f") -> {{{self.type_text(d.outty)}}}")
+            if d.body is not None:
+                items.append("\n{")
+                for stmt in d.body:
+                    items += ["\n" + self.indent, stmt]
+                items.append("\n}" if d.body else "\n\n}")
+            return items
+
+        elif d.storage in (Definition.STRUCT, Definition.UNION):
+            items = [f"Define {d.storage} {d.name}"]
+            if d.packed or d.align is not None:
+                items.append(" [")
+                if d.packed:
+                    items.append("packed, " if d.align is not None else "packed")
+                if d.align is not None:
+                    items += ["aligned(", self.leaf(d.align), ")"]
+                items.append("]")
+            items.append("\n{")
+            for member in d.members:
+                items.append(f"\n{self.indent}{member.name}: {{{self.type_text(member.ty)}}}")
+            items.append("\n}" if d.members else "\n\n}")
+            return items
+        return []
+
+
+def or_none(node):
+    return "None" if node is None else node
+
+
+def to_string(node) -> str:
+    """What `str(node)` gives, built without recursion."""
+    printer = Printer(None, chunk_size=float("inf"))
+    printer.walk(node)
+    return "".join(printer.parts)
+
+
+def write(defns: Iterable[Definition], out: TextIO):
+    """Writes each definition on its own line(s) as soon as the iterable produces it."""
+    printer = Printer(out)
+    for defn in defns:
+        printer.walk(defn)
+        printer.write("\n")
+    printer.flush()
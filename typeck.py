@@ -1,15 +1,28 @@
-from typing import List, Dict
-from parser import Statement, Expression, Definition, Type
+import re
+
+from array import array
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+from parser import Statement, Expression, Definition, FunctionParam, Type, char_type, int_type
+from visitor import SKIP, Visitor
+
+
+class LayoutError(Exception):
+    pass
 
 
 class Member:
-    def __init__(self, offs: int, ty: 'TypeLayout'):
+    def __init__(self, offs: int, ty: 'TypeLayout', decl: Optional[Type] = None):
         self.offs = offs
         self.ty = ty
+        # The member's declared type, when laid out from a definition
+        self.decl = decl
 
 
 class TypeLayout:
     INTEGRAL = "integral"
+    STRUCT = "struct"
+    UNION = "union"
+    ARRAY = "array"
 
     storage = None
 
@@ -18,6 +31,9 @@ class TypeLayout:
     align = None
     unsigned = None
     members = None
+    elem = None
+    count = None
+    table = None
 
     @staticmethod
     def integral(name: str, size: int, align: int, unsigned: bool):
@@ -28,64 +44,870 @@ class TypeLayout:
         tl.align = align
         tl.unsigned = unsigned
         return tl
-    
+
     @staticmethod
-    def struct(name: str, members: List[str, TypeLayout]):
+    def array(elem: 'TypeLayout', count: int):
         tl = TypeLayout()
+        tl.storage = TypeLayout.ARRAY
+        tl.name = f"{elem.name}[{count}]"
+        tl.size = elem.size * count
+        tl.align = elem.align
+        tl.elem = elem
+        tl.count = count
+        return tl
+
+    @staticmethod
+    def struct(name: str, members: List[Tuple[str, 'TypeLayout']], packed: bool = False, align: Optional[int] = None):
+        tl = TypeLayout()
+        tl.storage = TypeLayout.STRUCT
+        tl.name = name
 
         curr_offs = 0
-        curr_align = 0
+        curr_align = 1
 
         member_dict = {}
         for mname, mlayout in members:
-            curr_offs = (curr_offs + mlayout.align - 1) // mlayout.align * mlayout.align
-            
-            assert mname not in member_dict
+            malign = 1 if packed else mlayout.align
+            curr_offs = (curr_offs + malign - 1) // malign * malign
+
+            if mname in member_dict:
+                raise LayoutError(f"duplicate member `{mname}` in {name}")
             member_dict[mname] = Member(curr_offs, mlayout)
-            
+
             curr_offs += mlayout.size
-            curr_align = max(curr_align, mlayout.align)
-        
-        tl.size = curr_offs
+            curr_align = max(curr_align, malign)
+
+        if align is not None:
+            curr_align = max(curr_align, align)
+
+        tl.size = (curr_offs + curr_align - 1) // curr_align * curr_align
         tl.align = curr_align
         tl.members = member_dict
         return tl
-    
+
     @staticmethod
-    def union(name: str, members: List[str, TypeLayout]):
+    def union(name: str, members: List[Tuple[str, 'TypeLayout']], packed: bool = False, align: Optional[int] = None):
         tl = TypeLayout()
+        tl.storage = TypeLayout.UNION
+        tl.name = name
 
         curr_size = 0
-        curr_align = 0
+        curr_align = 1
 
         member_dict = {}
         for mname, mlayout in members:
-            assert mname not in member_dict
+            if mname in member_dict:
+                raise LayoutError(f"duplicate member `{mname}` in {name}")
             member_dict[mname] = Member(0, mlayout)
-            
+
             curr_size = max(curr_size, mlayout.size)
-            curr_align = max(curr_align, mlayout.align)
-        
-        tl.size = curr_size
+            curr_align = max(curr_align, 1 if packed else mlayout.align)
+
+        if align is not None:
+            curr_align = max(curr_align, align)
+
+        tl.size = (curr_size + curr_align - 1) // curr_align * curr_align
         tl.align = curr_align
         tl.members = member_dict
         return tl
 
+    def member_table(self) -> 'MemberTable':
+        if self.table is None:
+            self.table = MemberTable(self)
+        return self.table
+
+
+# An array index in a member path
+path_index = re.compile(r"\[\s*(\d+)\s*\]")
+
+
+class MemberTable:
+    """
+    Every member path of a layout (`a`, `a.b`, `a.b[].c`, ...) with its offset
+    from the start of the whole object, built once so that a lookup is a
+    single dict access. Array elements are entered once, as `name[]`; the
+    indices of a query like `a.b[3].c` are scaled by the element sizes.
+    Members without a name (anonymous structs and unions) are entered under
+    their members' names, as C has it.
+    """
+
+    def __init__(self, layout: TypeLayout):
+        self.name = layout.name
+        self.rows: Dict[str, int] = {}
+        self.paths: List[str] = []
+        self.offsets = array("Q")
+        self.sizes = array("Q")
+        self.layouts: List[TypeLayout] = []
+        # Element size for each `[]` in the path, outermost first
+        self.strides: List[Tuple[int, ...]] = []
+
+        # Depth first, so that rows come in declaration order
+        stack = [("", 0, layout, (), False)]
+        while stack:
+            path, offs, tl, strides, named = stack.pop()
+            if named:
+                self.add(path, offs, tl, strides)
+            if tl.storage == TypeLayout.ARRAY:
+                stack.append((path + "[]", offs, tl.elem, strides + (tl.elem.size,), True))
+            elif tl.members is not None:
+                for mname, member in reversed(tl.members.items()):
+                    if mname is None:
+                        # Anonymous members don't get a row of their own
+                        member_path = path
+                    else:
+                        member_path = f"{path}.{mname}" if path else mname
+                    stack.append((member_path, offs + member.offs, member.ty, strides, mname is not None))
+
+    def add(self, path: str, offs: int, tl: TypeLayout, strides: Tuple[int, ...]):
+        self.rows[path] = len(self.paths)
+        self.paths.append(path)
+        self.offsets.append(offs)
+        self.sizes.append(tl.size)
+        self.layouts.append(tl)
+        self.strides.append(strides)
+
+    def lookup(self, path: str) -> Tuple[int, TypeLayout]:
+        """Offset and layout of the member at `path`, e.g. `a.b[3].c`."""
+        indices = path_index.findall(path)
+        key = path_index.sub("[]", path.replace(" ", "")) if indices else path
+        row = self.rows.get(key)
+        if row is None:
+            raise LayoutError(f"{self.name} has no member `{path}`")
+        offs = self.offsets[row]
+        if indices:
+            for index, stride in zip(indices, self.strides[row]):
+                offs += int(index) * stride
+        return offs, self.layouts[row]
+
+    def export(self) -> Tuple[List[str], array, array]:
+        """
+        The table as parallel columns: paths, offsets and sizes. The stride of
+        each `[]` is the size of the row for the path up to it.
+        """
+        return self.paths, self.offsets, self.sizes
+
+
+class DataModel:
+    """The sizes and alignments of the builtin types on some family of targets."""
+
+    def __init__(self, name: str, long: int, pointer: int, long_double: Tuple[int, int], max_align: int):
+        self.name = name
+        self.pointer = TypeLayout.integral("pointer", size=pointer, align=pointer, unsigned=True)
+        # Alignment of `__attribute__((aligned))` without an argument
+        self.max_align = max_align
+        self.types: Dict[str, TypeLayout] = {
+            "signed char":          TypeLayout.integral("signed char",          size=1, align=1, unsigned=False),
+            "char":                 TypeLayout.integral("char",                 size=1, align=1, unsigned=True),
+            "unsigned char":        TypeLayout.integral("unsigned char",        size=1, align=1, unsigned=True),
+            "bool":                 TypeLayout.integral("bool",                 size=1, align=1, unsigned=True),
+            "short":                TypeLayout.integral("short",                size=2, align=2, unsigned=False),
+            "unsigned short":       TypeLayout.integral("unsigned short",       size=2, align=2, unsigned=True),
+            "int":                  TypeLayout.integral("int",                  size=4, align=4, unsigned=False),
+            "unsigned":             TypeLayout.integral("unsigned",             size=4, align=4, unsigned=True),
+            "long":                 TypeLayout.integral("long",                 size=long, align=long, unsigned=False),
+            "unsigned long":        TypeLayout.integral("unsigned long",        size=long, align=long, unsigned=True),
+            "long long":            TypeLayout.integral("long long",            size=8, align=8, unsigned=False),
+            "unsigned long long":   TypeLayout.integral("unsigned long long",   size=8, align=8, unsigned=True),
+            "float":                TypeLayout.integral("float",                size=4, align=4, unsigned=False),
+            "double":               TypeLayout.integral("double",               size=8, align=8, unsigned=False),
+            "long double":          TypeLayout.integral("long double",          *long_double, unsigned=False),
+        }
+        self.types["_Bool"] = self.types["bool"]
+
+
+ILP32 = DataModel("ILP32", long=4, pointer=4, long_double=(12, 4), max_align=16)
+LP64 = DataModel("LP64", long=8, pointer=8, long_double=(16, 16), max_align=16)
+data_models = { model.name: model for model in (ILP32, LP64) }
+
+
+type_names: Dict[Tuple[str, ...], str] = {}
+
+def type_name(words: Tuple[str, ...]) -> str:
+    """
+    The spelling of a value type that `DataModel.types` uses: `long int` is
+    `long`, `signed` is `int`, `unsigned int` is `unsigned` and so on.
+    """
+    if words[0] in ("struct", "union", "enum"):
+        return " ".join(words)
+    name = type_names.get(words)
+    if name is None:
+        parts = list(words)
+        if len(parts) > 1 and "int" in parts:
+            parts.remove("int")
+        if parts[0] == "signed" and parts[1:] != ["char"]:
+            parts = parts[1:] or ["int"]
+        name = type_names[words] = " ".join(parts)
+    return name
+
+
+# Integer conversion rank of the types left after the integer promotions
+ranks = {
+    "int": 1, "unsigned": 1,
+    "long": 2, "unsigned long": 2,
+    "long long": 3, "unsigned long long": 3,
+}
+unsigned_types = { "int": "unsigned", "long": "unsigned long", "long long": "unsigned long long" }
+floating_types = {"float", "double", "long double"}
+# The types an integer literal may get, smallest first
+literal_types = ("int", "unsigned", "long", "unsigned long", "long long", "unsigned long long")
+
+# A constant: its value and the name of its type
+Constant = Tuple[int, str]
+
+
+class Arithmetic:
+    """
+    C integer arithmetic under one data model: operands are promoted and
+    converted to a common type, unsigned results wrap around, and operations
+    whose behaviour is undefined (signed overflow, division by zero, shifts
+    past the width) give None instead of a value.
+    """
+
+    def __init__(self, model: DataModel = LP64):
+        self.model = model
+
+    def bounds(self, name: str) -> Tuple[int, int]:
+        tl = self.model.types[name]
+        bits = 8 * tl.size
+        if tl.unsigned:
+            return 0, (1 << bits) - 1
+        return -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+
+    def fits(self, value: int, name: str) -> bool:
+        lo, hi = self.bounds(name)
+        return lo <= value <= hi
+
+    def wrap(self, value: int, name: str) -> int:
+        tl = self.model.types[name]
+        bits = 8 * tl.size
+        value &= (1 << bits) - 1
+        if not tl.unsigned and value >> (bits - 1):
+            value -= 1 << bits
+        return value
+
+    def promote(self, name: str) -> str:
+        # Everything narrower than int fits in an int
+        return name if name in ranks else "int"
+
+    def common(self, a: str, b: str) -> str:
+        """The type both operands of an arithmetic operator are converted to."""
+        a, b = self.promote(a), self.promote(b)
+        if a == b:
+            return a
+        a_unsigned = self.model.types[a].unsigned
+        b_unsigned = self.model.types[b].unsigned
+        if a_unsigned == b_unsigned:
+            return a if ranks[a] > ranks[b] else b
+        signed, unsigned = (b, a) if a_unsigned else (a, b)
+        if ranks[unsigned] >= ranks[signed]:
+            return unsigned
+        if self.model.types[signed].size > self.model.types[unsigned].size:
+            return signed
+        return unsigned_types[signed]
+
+    def literal(self, e: Expression) -> Optional[Constant]:
+        """
+        The value and type of an INTEGER node, if its type is integral. The
+        parser types a literal by its suffix alone; C gives it the first type
+        from there on that can hold its value, never a signed one after `u`
+        and never an unsigned one for a decimal literal without `u`.
+        """
+        name = type_name(e.ty.val)
+        if name not in self.model.types or name in floating_types:
+            return None
+        if name not in ranks or self.fits(e.intval, name):
+            return e.intval, name
+        unsigned = self.model.types[name].unsigned
+        for wider in literal_types:
+            wider_unsigned = self.model.types[wider].unsigned
+            if ranks[wider] < ranks[name] or (unsigned and not wider_unsigned) or (e.decimal and not unsigned and wider_unsigned):
+                continue
+            if self.fits(e.intval, wider):
+                return e.intval, wider
+        return None
+
+    def prefix(self, op: str, a: Constant) -> Optional[Constant]:
+        value, name = a
+        if op == "!":
+            return int(not value), "int"
+        name = self.promote(name)
+        if op == "+":
+            return value, name
+        elif op == "-":
+            result = -value
+        elif op == "~":
+            result = ~value
+        else:
+            return None
+        if self.model.types[name].unsigned or op == "~":
+            return self.wrap(result, name), name
+        return (result, name) if self.fits(result, name) else None
+
+    def infix(self, op: str, a: Constant, b: Constant) -> Optional[Constant]:
+        (x, a_name), (y, b_name) = a, b
+        if op == "&&":
+            return int(bool(x) and bool(y)), "int"
+        elif op == "||":
+            return int(bool(x) or bool(y)), "int"
+
+        if op in ("<<", ">>"):
+            # The result has the type of the promoted left operand
+            name = self.promote(a_name)
+            if y < 0 or y >= 8 * self.model.types[name].size:
+                return None
+            if op == ">>":
+                return x >> y, name
+            result = x << y
+            if self.model.types[name].unsigned:
+                return self.wrap(result, name), name
+            return (result, name) if x >= 0 and self.fits(result, name) else None
+
+        name = self.common(a_name, b_name)
+        x, y = self.wrap(x, name), self.wrap(y, name)
+        if op in ("==", "!=", "<", "<=", ">", ">="):
+            return int(compare[op](x, y)), "int"
+
+        if op == "+":
+            result = x + y
+        elif op == "-":
+            result = x - y
+        elif op == "*":
+            result = x * y
+        elif op in ("/", "%"):
+            if y == 0:
+                return None
+            # C division truncates towards zero
+            quot = abs(x) // abs(y) * (1 if (x < 0) == (y < 0) else -1)
+            result = quot if op == "/" else x - quot * y
+        elif op == "&":
+            result = x & y
+        elif op == "|":
+            result = x | y
+        elif op == "^":
+            result = x ^ y
+        else:
+            return None
+
+        if self.model.types[name].unsigned:
+            return self.wrap(result, name), name
+        return (result, name) if self.fits(result, name) else None
+
+
+compare = {
+    "==": lambda x, y: x == y,
+    "!=": lambda x, y: x != y,
+    "<": lambda x, y: x < y,
+    "<=": lambda x, y: x <= y,
+    ">": lambda x, y: x > y,
+    ">=": lambda x, y: x >= y,
+}
+
+
+class Evaluator(Visitor):
+    """Works out the value of every constant subexpression, without changing the tree."""
+
+    visit_types = False
+
+    def __init__(self, model: DataModel = LP64):
+        super().__init__()
+        self.arith = Arithmetic(model)
+        self.values: Dict[int, Constant] = {}
+
+    def post_expression(self, e: Expression):
+        values = self.values
+        value = None
+        if e.storage == Expression.INTEGER:
+            value = self.arith.literal(e)
+        elif e.storage == Expression.PREFIX:
+            a = values.get(id(e.exp1))
+            if a is not None:
+                value = self.arith.prefix(e.op, a)
+        elif e.storage == Expression.INFIX:
+            a, b = values.get(id(e.exp1)), values.get(id(e.exp2))
+            if a is not None and b is not None:
+                value = self.arith.infix(e.op, a, b)
+        elif e.storage == Expression.VARIABLE and e.varname == "__BIGGEST_ALIGNMENT__":
+            value = self.arith.model.max_align, "int"
+        if value is not None:
+            values[id(e)] = value
+
+
+def evaluate(expr: Expression, model: DataModel = LP64) -> Optional[Constant]:
+    """The value and type of `expr`, if it is a constant expression."""
+    evaluator = Evaluator(model)
+    evaluator.walk(expr)
+    return evaluator.values.get(id(expr))
+
+
+def record_key(defn: Definition) -> str:
+    return f"{defn.storage} {defn.name}"
+
+
+def value_record(ty: Type) -> Optional[str]:
+    """The struct or union that `ty` holds by value, directly or in an array."""
+    while ty.storage == Type.ARRAY:
+        ty = ty.pointee
+    if ty.storage == Type.VALUE and ty.val[0] in ("struct", "union"):
+        return type_name(ty.val)
+    return None
+
+
+class LayoutEngine:
+    """
+    Lays out every struct and union of a set of definitions under one data
+    model. Records that contain others by value depend on them; layouts are
+    computed once, in dependency order, and kept until a record they depend
+    on changes. Layouts of types are memoized on the (interned) `Type`.
+    """
+
+    def __init__(self, model: DataModel = LP64):
+        self.model = model
+        self.records: Dict[str, Definition] = {}
+        self.deps: Dict[str, Set[str]] = {}
+        self.dependents: Dict[str, Set[str]] = {}
+        self.layouts: Dict[str, TypeLayout] = {}
+        self.errors: Dict[str, LayoutError] = {}
+        self.pending: Set[str] = set()
+        self.type_layouts: Dict[Type, TypeLayout] = {}
+
+    def update(self, defns: Iterable[Definition]):
+        """
+        Moves to a new set of top-level definitions. A record counts as changed
+        if its `Definition` is not the same object as before (`IncrementalParser`
+        keeps the objects of unchanged definitions); it and
+        everything containing it is laid out again, the rest is kept.
+        """
+        records = {}
+        for defn in defns:
+            if defn.storage in (Definition.STRUCT, Definition.UNION) and defn.name is not None:
+                records[record_key(defn)] = defn
+
+        changed = [key for key in self.records.keys() | records.keys() if self.records.get(key) is not records.get(key)]
+        for key in changed:
+            for dep in self.deps.pop(key, ()):
+                self.dependents[dep].discard(key)
+            if key in records:
+                deps = self.deps[key] = set()
+                for member in records[key].members:
+                    if (dep := value_record(member.ty)) is not None:
+                        deps.add(dep)
+                        self.dependents.setdefault(dep, set()).add(key)
+        self.records = records
+        self.invalidate(changed)
+
+    def invalidate(self, keys: Iterable[str]):
+        """Forgets the layouts of the given records and of everything that contains them."""
+        dirty = set()
+        stack = list(keys)
+        while stack:
+            key = stack.pop()
+            if key not in dirty:
+                dirty.add(key)
+                stack.extend(self.dependents.get(key, ()))
+        if not dirty:
+            return
+
+        for key in dirty:
+            self.layouts.pop(key, None)
+            self.errors.pop(key, None)
+        self.pending |= dirty & self.records.keys()
+        self.pending -= dirty - self.records.keys()
+        self.type_layouts = {
+            ty: tl for ty, tl in self.type_layouts.items() if value_record(ty) not in dirty
+        }
+
+    def resolve(self):
+        """Lays out every pending record, each after the records it contains."""
+        pending = self.pending
+        indegree = { key: sum(dep in pending for dep in self.deps[key]) for key in pending }
+        ready = [key for key, n in indegree.items() if n == 0]
+        while ready:
+            key = ready.pop()
+            try:
+                self.layouts[key] = self.layout_record(self.records[key])
+            except LayoutError as e:
+                self.errors[key] = e
+            pending.discard(key)
+            for user in self.dependents.get(key, ()):
+                if user in indegree:
+                    indegree[user] -= 1
+                    if indegree[user] == 0:
+                        ready.append(user)
+
+        # Whatever is left contains itself
+        for key in pending:
+            self.errors[key] = LayoutError(f"{key} contains itself")
+        pending.clear()
+
+    def record(self, key: str) -> TypeLayout:
+        tl = self.layouts.get(key)
+        if tl is None:
+            if key in self.pending:
+                self.resolve()
+                tl = self.layouts.get(key)
+            if tl is None:
+                raise self.errors.get(key) or LayoutError(f"{key} is incomplete")
+        return tl
+
+    def layout(self, ty: Type) -> TypeLayout:
+        tl = self.type_layouts.get(ty)
+        if tl is None:
+            tl = self.type_layouts[ty] = self.layout_type(ty)
+        return tl
+
+    def layout_type(self, ty: Type) -> TypeLayout:
+        if ty.storage in (Type.POINTER, Type.FUNCPTR):
+            return self.model.pointer
+
+        elif ty.storage == Type.ARRAY:
+            # An array without a size is a flexible array member
+            count = 0 if ty.size is None else self.constant(ty.size)
+            return TypeLayout.array(self.layout(ty.pointee), count)
+
+        name = type_name(ty.val)
+        if ty.val[0] in ("struct", "union"):
+            return self.record(name)
+        elif ty.val[0] == "enum":
+            return self.model.types["int"]
+        elif name in self.model.types:
+            return self.model.types[name]
+        raise LayoutError(f"unknown type `{name}`")
+
+    def layout_record(self, defn: Definition) -> TypeLayout:
+        members = [(member.name, self.layout(member.ty)) for member in defn.members]
+        align = None
+        if defn.align is not None:
+            align = self.constant(defn.align)
+            if align <= 0 or align & (align - 1):
+                raise LayoutError(f"alignment of {record_key(defn)} is not a power of two")
+        factory = TypeLayout.struct if defn.storage == Definition.STRUCT else TypeLayout.union
+        tl = factory(record_key(defn), members, defn.packed, align)
+        for member in defn.members:
+            tl.members[member.name].decl = member.ty
+        return tl
+
+    def named(self, name: str) -> TypeLayout:
+        """Layout of a type by name, like `struct foo` or `unsigned long int`."""
+        words = tuple(name.split())
+        if words and words[0] in ("struct", "union"):
+            return self.record(" ".join(words))
+        tl = self.model.types.get(type_name(words)) if words else None
+        if tl is None:
+            raise LayoutError(f"unknown type `{name}`")
+        return tl
+
+    def offsetof(self, queries: Iterable[Tuple[str, str]]) -> List[int]:
+        """`offsetof(T, path)` for every (T, path), e.g. `("struct foo", "a.b[3].c")`."""
+        return [self.named(name).member_table().lookup(path)[0] for name, path in queries]
+
+    def sizeof(self, queries: Iterable[Union[str, Tuple[str, str]]]) -> List[int]:
+        """The size of every type named, or of every (T, path) member."""
+        sizes = []
+        for query in queries:
+            if isinstance(query, str):
+                sizes.append(self.named(query).size)
+            else:
+                name, path = query
+                sizes.append(self.named(name).member_table().lookup(path)[1].size)
+        return sizes
+
+    def constant(self, expr: Expression) -> int:
+        if expr.storage == Expression.INTEGER:
+            return expr.intval
+        value = evaluate(expr, self.model)
+        if value is None:
+            raise LayoutError(f"{expr} is not a constant")
+        return value[0]
+
+
+def typelist(defs: List[Definition], model: DataModel = LP64) -> Dict[str, TypeLayout]:
+    """The builtin types of `model` and the layouts of every struct and union in `defs`."""
+    engine = LayoutEngine(model)
+    engine.update(defs)
+    defined_types = dict(model.types)
+    for key in engine.records:
+        defined_types[key] = engine.record(key)
+    return defined_types
+
+
+Declaration = Union[Definition, FunctionParam]
+
+
+class NameResolver(Visitor):
+    """
+    Points `decl` of every VARIABLE expression at the Definition or
+    FunctionParam it names, following C's block scoping: globals, then a
+    function's parameters and body, then each nested block. Every name has
+    a stack of the declarations that shadow one another, so a lookup is one
+    dict access however deep the nesting, and leaving a scope pops just the
+    names it declared. Names that aren't declared anywhere in sight are
+    collected in `unresolved`.
+
+    A declaration is in scope from its own initializer on, as in C. Struct
+    and union members are not variables, so records are skipped.
+    """
+
+    def __init__(self, outer: Optional[Dict[str, Declaration]] = None):
+        super().__init__()
+        # Declarations of names this walk hasn't seen declared, if any
+        self.outer = outer or {}
+        self.bindings: Dict[str, List[Declaration]] = {}
+        # The names declared in each open scope, innermost last
+        self.scopes: List[List[str]] = [[]]
+        self.unresolved: List[Expression] = []
+
+    def declare(self, name: Optional[str], decl: Declaration):
+        if name is None:
+            return
+        stack = self.bindings.get(name)
+        if stack is None:
+            stack = self.bindings[name] = []
+        stack.append(decl)
+        self.scopes[-1].append(name)
+
+    def lookup(self, name: str) -> Optional[Declaration]:
+        stack = self.bindings.get(name)
+        return stack[-1] if stack else self.outer.get(name)
+
+    def enter(self):
+        self.scopes.append([])
+
+    def leave(self):
+        bindings = self.bindings
+        for name in self.scopes.pop():
+            stack = bindings[name]
+            stack.pop()
+            if not stack:
+                del bindings[name]
+
+    def pre_type(self, t: Type):
+        # Only array sizes can name variables
+        if t.storage == Type.ARRAY:
+            return None if t.size is not None and t.size.storage != Expression.INTEGER else SKIP
+        if t.storage == Type.VALUE:
+            return SKIP
+
+    def pre_definition(self, d: Definition):
+        if d.storage in (Definition.STRUCT, Definition.UNION):
+            return SKIP
+        self.declare(d.name, d)
+        if d.storage == Definition.FUNCTION:
+            if d.body is None:
+                return SKIP
+            self.enter()
+            for param in d.paramtys:
+                self.declare(param.name, param)
+
+    def post_definition(self, d: Definition):
+        # Prototypes were skipped without opening a scope
+        if d.storage == Definition.FUNCTION and d.body is not None:
+            self.leave()
+
+    def pre_statement(self, s: Statement):
+        if s.storage == Statement.BLOCK:
+            self.enter()
+
+    def post_statement(self, s: Statement):
+        if s.storage == Statement.BLOCK:
+            self.leave()
+
+    def pre_expression(self, e: Expression):
+        if e.storage == Expression.VARIABLE:
+            e.decl = self.lookup(e.varname)
+            if e.decl is None:
+                self.unresolved.append(e)
+
+
+def resolve_names(defns: Iterable[Definition]) -> List[Expression]:
+    """
+    Resolves every variable reference in `defns`, a whole translation unit in
+    order, setting `Expression.decl`. Returns the references left unresolved.
+    """
+    resolver = NameResolver()
+    for defn in defns:
+        resolver.walk(defn)
+    return resolver.unresolved
+
+
+string_type = Type.pointer(char_type)
+comparison_operators = {"==", "!=", "<", "<=", ">", ">=", "&&", "||"}
+assignment_operators = {"=", "+=", "-=", "*=", "/=", "%=", "<<=", ">>=", "&=", "^=", "|="}
+
+
+def decay(ty: Type) -> Type:
+    """An array used as a value is a pointer to its first element."""
+    return Type.pointer(ty.pointee) if ty.storage == Type.ARRAY else ty
+
+
+class TypeInference(Visitor):
+    """
+    Fills in `Expression.ty` for every expression of the definitions it's
+    asked about, bottom up: integer promotions and the usual arithmetic
+    conversions, pointer arithmetic, indexing, and member access through
+    the record layouts of `engine`. Types are built by the `Type` factories,
+    so they're the interned ones.
+
+    `ty` is the memo: a typed expression (and so everything under it) is
+    never looked at again. Work happens per definition and only when asked
+    for, so checking a few functions of a big file costs only those
+    functions, whose lazy bodies stay unparsed otherwise. Expressions whose
+    type can't be known, like references to undeclared names, are left
+    without one.
+    """
+
+    visit_types = False
+
+    def __init__(self, defns: Iterable[Definition], engine: Optional[LayoutEngine] = None):
+        super().__init__()
+        defns = list(defns)
+        if engine is None:
+            engine = LayoutEngine()
+            engine.update(defns)
+        self.engine = engine
+        self.arith = Arithmetic(engine.model)
+        # Top-level names for resolving functions one at a time; the last
+        # declaration wins, so a definition beats its prototype. Struct and
+        # union tags are a namespace of their own.
+        self.globals: Dict[str, Declaration] = {
+            defn.name: defn for defn in defns
+            if defn.name is not None and defn.storage not in (Definition.STRUCT, Definition.UNION)
+        }
+        self.done: Dict[int, Definition] = {}
+
+    def definition(self, defn: Definition):
+        """Types every expression in `defn`, resolving its names first, once."""
+        if id(defn) in self.done:
+            return
+        self.done[id(defn)] = defn
+        if defn.storage in (Definition.STRUCT, Definition.UNION):
+            return
+        NameResolver(self.globals).walk(defn)
+        self.walk(defn)
+
+    def type_of(self, e: Expression) -> Optional[Type]:
+        """The type of `e`, whose names must already be resolved."""
+        if e.ty is None:
+            self.walk(e)
+        return e.ty
+
+    def pre_expression(self, e: Expression):
+        if e.ty is not None:
+            return SKIP
+
+    def post_expression(self, e: Expression):
+        if e.ty is None:
+            e.ty = self.infer(e)
+
+    def arithmetic(self, ty: Type) -> Optional[str]:
+        """The `DataModel.types` name of an arithmetic type."""
+        if ty.storage != Type.VALUE:
+            return None
+        name = type_name(ty.val)
+        if ty.val[0] == "enum":
+            return "int"
+        return name if name in self.arith.model.types else None
+
+    def value(self, name: str) -> Type:
+        return Type.value(name.split())
+
+    def promote(self, name: str) -> str:
+        return name if name in floating_types else self.arith.promote(name)
+
+    def member(self, ty: Optional[Type], name: str) -> Optional[Type]:
+        if ty is None or ty.storage != Type.VALUE or ty.val[0] not in ("struct", "union"):
+            return None
+        try:
+            members = self.engine.layout(ty).members
+        except LayoutError:
+            return None
+        member = members.get(name)
+        return None if member is None else member.decl
+
+    def infer(self, e: Expression) -> Optional[Type]:
+        storage = e.storage
+        if storage == Expression.VARIABLE:
+            decl = e.decl
+            if decl is None:
+                return None
+            elif type(decl) is FunctionParam or decl.storage == Definition.VALUE:
+                return decl.ty
+            elif decl.storage == Definition.FUNCTION:
+                return Type.funcptr(decl.outty, [param.ty for param in decl.paramtys])
+            return None
+
+        elif storage == Expression.STRING:
+            return string_type
+
+        a = e.exp1.ty
+        if a is None:
+            return None
+
+        if storage == Expression.POSTFIX:
+            return a
+
+        elif storage == Expression.DECONSTRUCT:
+            if e.op == "->":
+                a = decay(a)
+                a = a.pointee if a.storage == Type.POINTER else None
+            return self.member(a, e.ident)
+
+        elif storage == Expression.PREFIX:
+            op = e.op
+            if op == "&":
+                return Type.pointer(a)
+            elif op == "*":
+                a = decay(a)
+                if a.storage == Type.POINTER:
+                    return a.pointee
+                return a if a.storage == Type.FUNCPTR else None
+            elif op == "!":
+                return int_type
+            elif op in ("++", "--"):
+                return a
+            name = self.arithmetic(a)
+            return None if name is None else self.value(self.promote(name))
+
+        b = e.exp2.ty
+        if b is None:
+            return None
 
+        if storage == Expression.INDEX:
+            a, b = decay(a), decay(b)
+            if a.storage == Type.POINTER:
+                return a.pointee
+            return b.pointee if b.storage == Type.POINTER else None
 
+        elif storage == Expression.INFIX:
+            op = e.op
+            if op in assignment_operators:
+                return a
+            elif op in comparison_operators:
+                return int_type
+            a, b = decay(a), decay(b)
+            a_name, b_name = self.arithmetic(a), self.arithmetic(b)
+            if op in ("+", "-") and a.storage == Type.POINTER:
+                if op == "-" and b.storage == Type.POINTER:
+                    # ptrdiff_t
+                    return self.value("long")
+                return a if b_name is not None else None
+            elif op == "+" and b.storage == Type.POINTER:
+                return b if a_name is not None else None
+            elif a_name is None or b_name is None:
+                return None
+            elif op in ("<<", ">>"):
+                return self.value(self.promote(a_name))
+            elif a_name in floating_types or b_name in floating_types:
+                # The widest floating operand wins
+                sizes = self.arith.model.types
+                return self.value(max((n for n in (a_name, b_name) if n in floating_types), key=lambda n: sizes[n].size))
+            return self.value(self.arith.common(a_name, b_name))
+        return None
 
-def typelist(defs: List[Definition]):
-    defined_types: Dict[str, TypeLayout] = {
-        "signed char":          TypeLayout.integral("signed char",          size=1, align=1, unsigned=False),
-        "char":                 TypeLayout.integral("char",                 size=1, align=1, unsigned=True),
-        "unsigned char":        TypeLayout.integral("unsigned char",        size=1, align=1, unsigned=True),
-        "short":                TypeLayout.integral("short",                size=2, align=2, unsigned=False),
-        "unsigned short":       TypeLayout.integral("unsigned short",       size=2, align=2, unsigned=True),
-        "int":                  TypeLayout.integral("int",                  size=4, align=4, unsigned=False),
-        "unsigned":             TypeLayout.integral("unsigned",             size=4, align=4, unsigned=True),
-        "long":                 TypeLayout.integral("long",                 size=4, align=4, unsigned=False),
-        "unsigned long":        TypeLayout.integral("unsigned long",        size=4, align=4, unsigned=True),
-        "long long":            TypeLayout.integral("long long",            size=8, align=8, unsigned=False),
-        "unsigned long long":   TypeLayout.integral("unsigned long long",   size=8, align=8, unsigned=True),
-    }
 
+def infer_types(defns: Iterable[Definition], engine: Optional[LayoutEngine] = None) -> TypeInference:
+    """Types every expression in `defns`. The returned inference can type more on demand."""
+    defns = list(defns)
+    inference = TypeInference(defns, engine)
+    for defn in defns:
+        inference.definition(defn)
+    return inference
@@ -0,0 +1,161 @@
+from parser import Type, FunctionParam, Definition, Expression, Statement
+from typing import Any, Dict, List, Optional, Tuple
+
+
+# The slots of every node class that hold other nodes, in source order, and
+# whether each holds a list of them. Only one of the slots of a Definition or
+# a Statement is set for any one storage, so their order only matters within it.
+child_slots: Dict[type, Tuple[Tuple[str, bool], ...]] = {
+    Type: (("pointee", False), ("outty", False), ("paramtys", True), ("size", False)),
+    FunctionParam: (("ty", False),),
+    Definition: (
+        ("outty", False), ("paramtys", True), ("body", True),
+        ("ty", False), ("val", False),
+        ("members", True), ("align", False),
+    ),
+    Expression: (("ty", False), ("exp1", False), ("exp2", False)),
+    Statement: (("defn", False), ("val", False), ("blk", True), ("body", False), ("body_else", False)),
+}
+
+# The kind each class's hooks are named after
+hook_names = {
+    Type: "type",
+    FunctionParam: "param",
+    Definition: "definition",
+    Expression: "expression",
+    Statement: "statement",
+}
+
+# Returned by a pre-order hook to leave the node's children alone
+SKIP = False
+
+
+class Visitor:
+    """
+    Walks an AST with an explicit stack instead of recursion, so trees of any
+    depth are fine. Subclasses define any of `pre_<kind>(node)` and
+    `post_<kind>(node)`, for the kinds `type`, `param`, `definition`,
+    `expression` and `statement`. Pre-order hooks run before a node's
+    children and can return SKIP to not visit them; post-order hooks run
+    after, and can return a node to put in this one's place.
+
+    Types are interned and shared, so they are never changed in place: when
+    one of a type's children is replaced, the type is rebuilt through its
+    factory and that replaces the type in turn. With `visit_types` off, types
+    are not visited at all.
+    """
+
+    visit_types = True
+
+    def __init__(self):
+        self.pre_hooks = { cls: getattr(self, "pre_" + kind, None) for cls, kind in hook_names.items() }
+        self.post_hooks = { cls: getattr(self, "post_" + kind, None) for cls, kind in hook_names.items() }
+        self.slots = child_slots if self.visit_types else {
+            cls: tuple(slot for slot in slots if (cls, slot[0]) not in type_slots)
+            for cls, slots in child_slots.items()
+        }
+
+    def children(self, node) -> List:
+        """
+        What to visit under `node`, in order. Children come as
+        `(child, node, slot, index, False)`, where `index` is the child's
+        position if the slot holds a list; that is what lets a post-order hook
+        replace them. Subclasses may also give plain nodes, which can't be
+        replaced, and strings, which are passed to `text` in their turn.
+        """
+        items = []
+        for slot, many in self.slots[type(node)]:
+            val = getattr(node, slot)
+            if val is None:
+                continue
+            if many:
+                items.extend((child, node, slot, i, False) for i, child in enumerate(val))
+            else:
+                items.append((val, node, slot, None, False))
+        return items
+
+    def text(self, text: str):
+        pass
+
+    def walk(self, node) -> Any:
+        """Visits `node` and everything under it. Returns `node`, or what replaced it."""
+        pre_hooks = self.pre_hooks
+        post_hooks = self.post_hooks
+        children = self.children
+        text = self.text
+        rewriting = any(hook is not None for hook in post_hooks.values())
+        root = [node]
+        # Replaced children of types, applied when the type itself is done
+        rebuilt: Dict[int, List[Tuple[str, Optional[int], Any]]] = {}
+
+        # Entries are strings, plain nodes or (node, parent, slot, index, children done)
+        stack: List = [(node, root, None, 0, False)]
+        while stack:
+            entry = stack.pop()
+            kind = type(entry)
+            if kind is str:
+                text(entry)
+                continue
+            elif kind is tuple:
+                node, parent, slot, index, done = entry
+                if done:
+                    self.finish(node, parent, slot, index, root, rebuilt)
+                    continue
+            else:
+                node = entry
+                parent = slot = index = None
+
+            cls = type(node)
+            hook = pre_hooks[cls]
+            items = children(node) if hook is None or hook(node) is not SKIP else ()
+            if post_hooks[cls] is not None or (rewriting and cls is Type):
+                stack.append((node, parent, slot, index, True))
+            stack.extend(reversed(items))
+        return root[0]
+
+    def finish(self, node, parent, slot: Optional[str], index: Optional[int], root: List, rebuilt: Dict):
+        """Runs the post-order hook of `node` and puts whatever replaces it in place."""
+        cls = type(node)
+        new = None
+        if cls is Type and id(node) in rebuilt:
+            new = node = rebuild_type(node, rebuilt.pop(id(node)))
+        hook = self.post_hooks[cls]
+        if hook is not None:
+            replacement = hook(node)
+            if replacement is not None and replacement is not node:
+                new = replacement
+        if new is None or parent is None:
+            return
+
+        if parent is root:
+            root[0] = new
+        elif type(parent) is Type:
+            rebuilt.setdefault(id(parent), []).append((slot, index, new))
+        elif index is None:
+            setattr(parent, slot, new)
+        else:
+            getattr(parent, slot)[index] = new
+
+
+# Slots that hold types, skipped when types aren't visited
+type_slots = {
+    (Type, "pointee"), (Type, "outty"), (Type, "paramtys"), (Type, "size"),
+    (FunctionParam, "ty"),
+    (Definition, "outty"), (Definition, "ty"),
+    (Expression, "ty"),
+}
+
+
+def rebuild_type(ty: Type, changes: List[Tuple[str, Optional[int], Any]]) -> Type:
+    fields = {
+        "pointee": ty.pointee,
+        "outty": ty.outty,
+        "paramtys": None if ty.paramtys is None else list(ty.paramtys),
+        "size": ty.size,
+    }
+    for slot, index, new in changes:
+        if index is None:
+            fields[slot] = new
+        else:
+            fields[slot][index] = new
+    return Type.make(ty.storage, fields["pointee"], ty.val, fields["outty"], fields["paramtys"], fields["size"])